@@ -0,0 +1,239 @@
+"""
+Benchmarks for the pharmaceutical blockchain in main.py.
+Run a single benchmark by name, e.g.:
+
+    python benchmarks.py memory --blocks 1000000
+"""
+
+import argparse # Reads the benchmark name and options from the command line
+import gc # Garbage collector, turned off while measuring so it doesn't skew the numbers
+import hashlib
+import json
+import os
+import random
+import tempfile # Scratch directory for the files a benchmark writes
+import time
+import timeit # Times small snippets of code accurately
+import tracemalloc # Tracks how much memory Python allocates
+
+from main import CODECS, HASH_FORMATS, Block, CompressedLedger, PharmaBlockChain
+
+
+def sample_event(i): # a realistic supply-chain event, similar to the ones in main.py
+    return {
+        "event": ("Manufactured", "Quality Tested", "Shipped", "Received", "Sold")[i % 5],
+        "batch_id": f"Batch {i // 7}",
+        "location": f"Factory {i % 13}",
+        "destination": f"Distributor {i % 17}"
+    }
+
+
+SUPPLY_TIERS = ( # (facility name, how many of them, a prime that spreads batches across them)
+    ("Factory", 50, 7919),
+    ("Distributor", 400, 104729),
+    ("Warehouse", 2000, 1299709),
+    ("Pharmacy", 20000, 15485863),
+)
+SUPPLY_STEPS = ( # (event, tier of the location, tier of the destination) for each step of a batch's journey
+    ("Manufactured", 0, 1),
+    ("Shipped", 0, 1),
+    ("Received", 1, 2),
+    ("Shipped", 2, 3),
+    ("Sold", 3, None),
+)
+
+
+def facility(batch, tier): # the facility of a tier that a batch goes through
+    name, count, prime = SUPPLY_TIERS[tier]
+    return f"{name} {batch * prime % 1000003 % count}" # the large prime keeps the tiers from nesting into a tree
+
+
+def supply_event(i, wave=1000):
+    """
+    One event of a synthetic supply network: factories -> distributors -> warehouses -> pharmacies -> customers.
+    Batches move in waves of `wave` batches that take each step together, so many batches share
+    the same facilities at the same time, as they do in a real recall.
+    """
+    steps = len(SUPPLY_STEPS)
+    batch = i // (wave * steps) * wave + i % wave
+    event, location, destination = SUPPLY_STEPS[i // wave % steps]
+    return {
+        "event": event,
+        "batch_id": f"Batch {batch}",
+        "location": facility(batch, location),
+        "destination": f"Customers {batch}" if destination is None else facility(batch, destination),
+    }
+
+
+class LegacyBlock: # the old Block layout: fields stored twice (attributes + block_info) plus a __dict__
+    def __init__(self, index, timestamp, data, prev_hash):
+        self.index = index
+        self.timestamp = timestamp
+        self.data = data
+        self.prev_hash = prev_hash
+        self.block_info = {
+            "Index": self.index,
+            "Timestamp": self.timestamp,
+            "Data": self.data,
+            "Previous Hash": self.prev_hash
+        }
+        self.hash = hashlib.sha256(json.dumps(self.block_info, sort_keys=True).encode()).hexdigest()
+
+
+def measure(build): # returns (bytes allocated, seconds) for whatever build() keeps alive
+    gc.collect()
+    gc.disable()
+    tracemalloc.start()
+    start = time.perf_counter()
+    kept = build()
+    elapsed = time.perf_counter() - start
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    gc.enable()
+    del kept
+    return allocated, elapsed
+
+
+def bench_memory(args):
+    """
+    Reports the resident bytes per block for a chain of args.blocks blocks.
+    * "block" is the current slotted Block, linked and hashed the way create_blocks does it
+    * "legacy" rebuilds the same blocks with the old dict-based layout for comparison
+    * Both are plain lists of blocks, so the chain's indexes (trails, postings, times, supply graph, ...)
+      aren't counted; they are the same whatever the block layout
+    * The event dictionaries are part of both numbers, since every real block carries one
+    """
+    n = args.blocks
+
+    def build_blocks():
+        blocks = [Block(0, time.time_ns(), {"Event": "Genesis Block"}, "0")]
+        for i in range(n):
+            blocks.append(Block(i + 1, time.time_ns(), sample_event(i), blocks[-1].hash))
+        return blocks
+
+    def build_legacy():
+        blocks = [LegacyBlock(0, time.ctime(), {"Event": "Genesis Block"}, "0")]
+        for i in range(n):
+            blocks.append(LegacyBlock(i + 1, time.ctime(), sample_event(i), blocks[-1].hash))
+        return blocks
+
+    print(f"{'layout':<8} {'blocks':>10} {'bytes/block':>12} {'seconds':>9}")
+    for name, build in (("block", build_blocks), ("legacy", build_legacy)):
+        allocated, elapsed = measure(build)
+        print(f"{name:<8} {n:>10} {allocated / (n + 1):>12.1f} {elapsed:>9.2f}")
+
+
+def bench_hashing(args):
+    """
+    Microbenchmark of the hot path: turning a block's fields into bytes and hashing them.
+    Reports microseconds per block for every entry in HASH_FORMATS.
+    """
+    blocks = [(i, time.ctime(), sample_event(i), "ab" * 32) for i in range(args.blocks)]
+    sha256 = hashlib.sha256
+
+    print(f"{'format':<10} {'blocks':>10} {'us/hash':>9} {'bytes':>7}")
+    for name, serialize in HASH_FORMATS.items():
+        def run():
+            for fields in blocks:
+                sha256(serialize(*fields)).hexdigest()
+        seconds = min(timeit.repeat(run, number=1, repeat=5))
+        size = len(serialize(*blocks[0]))
+        print(f"{name:<10} {len(blocks):>10} {seconds / len(blocks) * 1e6:>9.2f} {size:>7}")
+
+
+def bench_compression(args):
+    """
+    Size/speed tradeoff of ledger archives (see PharmaBlockChain.write_archive) for every codec and frame size.
+    * "ratio" is the archive size relative to the plain CSV ledger of the same chain
+    * "write" is the time to compress and write the whole archive, "scan" the time to read every block back
+    * "us/read" is the average time to read one random block, which decompresses the frame holding it
+    """
+    chain = PharmaBlockChain()
+    chain.create_blocks(sample_event(i) for i in range(args.blocks))
+    picks = random.Random(0).sample(range(len(chain.chain)), min(1000, len(chain.chain)))
+
+    with tempfile.TemporaryDirectory() as directory:
+        ledger_path = os.path.join(directory, "ledger.csv")
+        chain.write_chain(ledger_path)
+        csv_size = os.path.getsize(ledger_path)
+        print(f"csv ledger: {csv_size} bytes for {len(chain.chain)} blocks")
+        print(f"{'codec':<6} {'frame':>6} {'bytes':>12} {'ratio':>7} {'write s':>8} {'scan s':>8} {'us/read':>9}")
+        for codec in CODECS:
+            for frame_blocks in args.frames:
+                path = os.path.join(directory, f"ledger.{codec}")
+                start = time.perf_counter()
+                chain.write_archive(path, codec, frame_blocks).close()
+                write_seconds = time.perf_counter() - start
+                size = os.path.getsize(path)
+
+                with CompressedLedger(path) as archive:
+                    start = time.perf_counter()
+                    for _ in archive:
+                        pass
+                    scan_seconds = time.perf_counter() - start
+
+                    start = time.perf_counter()
+                    for n in picks:
+                        archive[n]
+                    read_seconds = time.perf_counter() - start
+                print(f"{codec:<6} {frame_blocks:>6} {size:>12} {size / csv_size:>7.3f} {write_seconds:>8.2f} "
+                      f"{scan_seconds:>8.2f} {read_seconds / len(picks) * 1e6:>9.1f}")
+
+
+def bench_recall(args):
+    """
+    Recall blast radius (PharmaBlockChain.recall_impact) on a synthetic supply network of args.blocks events
+    (see supply_event); the reference run is --blocks 10000000, which needs a machine with plenty of memory.
+    * Each query recalls a random batch or factory, limited to a time window covering two waves of shipments
+    * "first ms" is how long until the first Impact is streamed, "total ms" until the search is done
+    * "scan ms" is one pass over the whole chain, what every hop of a search costs without the indexes
+    """
+    chain = PharmaBlockChain()
+    start = time.perf_counter()
+    chain.create_blocks(supply_event(i, args.wave) for i in range(args.blocks))
+    print(f"built {len(chain.chain)} blocks in {time.perf_counter() - start:.1f} s")
+
+    start = time.perf_counter()
+    for block in chain.chain:
+        block.data.get("location") == "Factory 0"
+    scan_ms = (time.perf_counter() - start) * 1e3
+
+    rng = random.Random(0)
+    wave_blocks = args.wave * len(SUPPLY_STEPS)
+    waves = max(1, args.blocks // wave_blocks)
+    print(f"{'subject':<16} {'hops':>4} {'found':>8} {'first ms':>9} {'total ms':>9} {'scan ms':>8}")
+    for _ in range(args.queries):
+        wave = rng.randrange(waves)
+        batch = wave * args.wave + rng.randrange(args.wave)
+        subject = f"Batch {batch}" if rng.random() < 0.5 else facility(batch, 0)
+        first_block = 1 + wave * wave_blocks
+        window = (chain.times[first_block], chain.times[min(first_block + 2 * wave_blocks, len(chain.times) - 1)])
+        for max_hops in (2, 4):
+            start = time.perf_counter()
+            first = None
+            found = set() # a corrected Impact for the same batch or location isn't counted twice
+            for impact in chain.recall_impact(subject, window, max_hops):
+                if first is None:
+                    first = time.perf_counter() - start
+                found.add((impact.kind, impact.name))
+            total = time.perf_counter() - start
+            print(f"{subject:<16} {max_hops:>4} {len(found):>8} {(first or 0) * 1e3:>9.2f} {total * 1e3:>9.2f} {scan_ms:>8.0f}")
+
+
+BENCHMARKS = {
+    "memory": bench_memory,
+    "hashing": bench_hashing,
+    "compression": bench_compression,
+    "recall": bench_recall,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the pharmaceutical blockchain")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--blocks", type=int, default=1_000_000, help="number of blocks to build")
+    parser.add_argument("--frames", type=int, nargs="+", default=[16, 256, 4096],
+                        help="frame sizes (blocks per frame) for the compression benchmark")
+    parser.add_argument("--wave", type=int, default=1000, help="batches that move together (recall benchmark)")
+    parser.add_argument("--queries", type=int, default=5, help="number of recalls to run (recall benchmark)")
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
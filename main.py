@@ -5,109 +5,2556 @@ This blockchain will track the path of pharmaceutical products.
 This is a real world application, since pharmaceuticals can sometimes be spiked with fentanyl or carry diseases.
 """
 
+import io # Wraps a binary file so it can be read as text from any byte offset
+import pickle # Saves Python objects (the chain's indexes) to a file and loads them back quickly
 import hashlib # The hash library provides secure hash functions that let you create hashes or message digests of data.
 import csv # Allows for comma-separated values files (e.g., Excel Spreadsheets)
 import json # Allows you to work with JavaScript Object Notation, a lightweight data format used for storing and exchanging data
 import time # Time-related functions
 import os # Provides functions for interacting with the operating system (e.g., checking if a file exists)
+import sqlite3 # A small SQL database stored in a single file (optional storage backend)
+import threading # Lets the write-ahead log sync to disk in the background while blocks keep coming in
+import mmap # Maps a file into memory so parts of it can be read without copying the whole file
+import zlib # Provides crc32 checksums for the binary ledger records, and fast compression for ledger archives
+import lzma # Slower but stronger compression for ledger archives
+import sys # Information about the running Python (e.g., the byte order of the machine)
+import functools # Higher-order tools, e.g., lru_cache (a size-limited cache for a function's results)
+import itertools # Tools for working with iterators (e.g., chaining two of them together)
+import heapq # Merges already sorted sequences into one sorted stream
+import struct # Packs numbers into fixed-size bytes (used by the binary hashing format)
+from array import array # Compact arrays of plain numbers (used for the lookup indexes)
+from bisect import bisect_left, bisect_right # Binary search over sorted lists
+from collections import deque, namedtuple # deque: a list with fast appends and pops at both ends; namedtuple: a tuple with named fields
+from concurrent.futures import ProcessPoolExecutor # Runs work on several CPU cores at once
+
+# Packers for the canonical binary encoding below
+_pack_len = struct.Struct(">I").pack # 4-byte big-endian length / count prefix
+_pack_int = struct.Struct(">q").pack # 8-byte big-endian signed integer
+_pack_float = struct.Struct(">d").pack # 8-byte big-endian IEEE 754 double
+_unpack_len = struct.Struct(">I").unpack_from
+_unpack_int = struct.Struct(">q").unpack_from
+_unpack_float = struct.Struct(">d").unpack_from
+
+def _canonical(value, parts): # appends the canonical encoding of value to parts
+    """
+    Every value is written as a one-byte type tag followed by its contents:
+       - strings are length-prefixed UTF-8, so no escaping is needed and no two values can run together
+       - dictionaries are written as a count followed by their items sorted by key (keys must be strings)
+       - lists and tuples are a count followed by their items, in order
+    The same value always produces the same bytes, which is what hashing needs.
+    """
+    kind = type(value)
+    if kind is str:
+        raw = value.encode()
+        parts.append(b"s" + _pack_len(len(raw)) + raw)
+    elif kind is dict:
+        parts.append(b"d" + _pack_len(len(value)))
+        for key in sorted(value):
+            if type(key) is not str:
+                raise TypeError(f"Canonical encoding needs string keys, got {key!r}")
+            raw = key.encode()
+            parts.append(_pack_len(len(raw)) + raw)
+            _canonical(value[key], parts)
+    elif kind is int:
+        if -(1 << 63) <= value < (1 << 63):
+            parts.append(b"i" + _pack_int(value))
+        else: # too big for 8 bytes, fall back to decimal digits
+            raw = str(value).encode()
+            parts.append(b"I" + _pack_len(len(raw)) + raw)
+    elif kind is bool:
+        parts.append(b"T" if value else b"F")
+    elif value is None:
+        parts.append(b"N")
+    elif kind is float:
+        parts.append(b"f" + _pack_float(value))
+    elif kind is list or kind is tuple:
+        parts.append(b"l" + _pack_len(len(value)))
+        for item in value:
+            _canonical(item, parts)
+    else:
+        raise TypeError(f"Canonical encoding does not support {kind.__name__} values")
+
+def _decode_canonical(buf, pos): # reads one value written by _canonical; returns (value, position after it)
+    tag = buf[pos]
+    pos += 1
+    if tag == 0x73: # "s"
+        size = _unpack_len(buf, pos)[0]
+        pos += 4
+        return str(buf[pos:pos + size], "utf-8"), pos + size
+    if tag == 0x64: # "d"
+        count = _unpack_len(buf, pos)[0]
+        pos += 4
+        value = {}
+        for _ in range(count):
+            size = _unpack_len(buf, pos)[0]
+            pos += 4
+            key = str(buf[pos:pos + size], "utf-8")
+            value[key], pos = _decode_canonical(buf, pos + size)
+        return value, pos
+    if tag == 0x69: # "i"
+        return _unpack_int(buf, pos)[0], pos + 8
+    if tag == 0x49: # "I"
+        size = _unpack_len(buf, pos)[0]
+        pos += 4
+        return int(str(buf[pos:pos + size], "ascii")), pos + size
+    if tag == 0x54: # "T"
+        return True, pos
+    if tag == 0x46: # "F"
+        return False, pos
+    if tag == 0x4E: # "N"
+        return None, pos
+    if tag == 0x66: # "f"
+        return _unpack_float(buf, pos)[0], pos + 8
+    if tag == 0x6C: # "l"
+        count = _unpack_len(buf, pos)[0]
+        pos += 4
+        value = []
+        for _ in range(count):
+            item, pos = _decode_canonical(buf, pos)
+            value.append(item)
+        return value, pos
+    raise ValueError(f"Unknown canonical type tag {tag!r} at byte {pos - 1}")
+
+def json_block_bytes(index, timestamp, data, prev_hash): # the original hashing format
+    block_info = {
+        "Index": index,
+        "Timestamp": timestamp,
+        "Data": data,
+        "Previous Hash": prev_hash
+    }
+    return json.dumps(block_info, sort_keys=True).encode()
+
+def canonical_block_bytes(index, timestamp, data, prev_hash): # versioned, length-prefixed binary format
+    parts = [b"PBC\x01"] # format name + version byte, so a future version can never collide with this one
+    _canonical(index, parts)
+    _canonical(timestamp, parts)
+    _canonical(data, parts)
+    _canonical(prev_hash, parts)
+    return b"".join(parts)
+
+# hash format name -> function that turns a block's fields into the bytes that get hashed
+HASH_FORMATS = {
+    "json": json_block_bytes,
+    "canon-v1": canonical_block_bytes,
+}
+
+# One problem found by PharmaBlockChain.find_tampering:
+#   index    - position of the bad block in the chain
+#   kind     - "link" if its previous hash doesn't match the block before it, "hash" if its stored hash doesn't match its contents
+#   expected - the hash that should be there (the previous block's hash, or the recomputed hash)
+#   actual   - the hash that is actually stored in the block
+Tampering = namedtuple("Tampering", ["index", "kind", "expected", "actual"])
+
+# One finding of PharmaBlockChain.recall_impact:
+#   kind  - "location" (a facility the recalled product reached) or "batch" (a batch that shared a facility with it)
+#   name  - the location, or the batch_id
+#   hops  - how many batch <-> location steps it is from what was recalled
+#   since - epoch_ns of the contact, i.e., the time from which it is affected
+#   via   - the batch or location it was reached through
+#   index - the block that records the contact
+Impact = namedtuple("Impact", ["kind", "name", "hops", "since", "via", "index"])
+
+def _recompute_hash(index, timestamp, data, prev_hash, block_hash, hash_format, legacy_json):
+    # recomputes a block's hash from its fields; returns None if it matches the stored one, otherwise the recomputed hash
+    computed = hashlib.sha256(HASH_FORMATS[hash_format](index, timestamp, data, prev_hash)).hexdigest()
+    if computed == block_hash:
+        return None
+    # compatibility mode: the block may have been hashed before the chain switched formats
+    if legacy_json and hash_format != "json":
+        if hashlib.sha256(json_block_bytes(index, timestamp, data, prev_hash)).hexdigest() == block_hash:
+            return None
+    return computed
+
+def _verify_range(start, rows, legacy_json):
+    """
+    Runs inside a worker process during a full validation.
+    * rows are the fields of one contiguous range of blocks, starting at chain position start
+    * Every block's hash is recomputed, and the links inside the range are checked
+      (the link into the first block is checked by the caller, who can see the previous range)
+    * Returns a Tampering for every broken link and every bad hash, in order. A block whose previous hash
+      was edited usually fails both checks, and then both are reported (the link first)
+    """
+    bad = []
+    prev_block_hash = None
+    for position, (index, timestamp, data, prev_hash, block_hash, hash_format) in enumerate(rows, start):
+        if prev_block_hash is not None and prev_hash != prev_block_hash:
+            bad.append(Tampering(position, "link", prev_block_hash, prev_hash))
+        computed = _recompute_hash(index, timestamp, data, prev_hash, block_hash, hash_format, legacy_json)
+        if computed is not None:
+            bad.append(Tampering(position, "hash", computed, block_hash))
+        prev_block_hash = block_hash
+    return bad
+
+def _digest(block_hash): # hex hash -> raw 32-byte digest, or None if it isn't a SHA-256 hex string (e.g., genesis "0")
+    if len(block_hash) != 64:
+        return None
+    try:
+        return bytes.fromhex(block_hash)
+    except ValueError:
+        return None
+
+@functools.lru_cache(maxsize=1024) # consecutive legacy blocks mostly share the same one-second ctime string
+def _parse_ctime(text): # a time.ctime() string (local time) -> epoch nanoseconds
+    return int(time.mktime(time.strptime(text))) * 1_000_000_000
+
+def epoch_ns(timestamp):
+    """
+    A block's timestamp as nanoseconds since the epoch, which sorts and compares like the times it stands for.
+    New blocks store exactly this (time.time_ns()); blocks from older ledgers hold a time.ctime() string, which
+    is parsed (to the second) but never rewritten, since the string is what their hash was computed from.
+    """
+    if type(timestamp) is int:
+        return timestamp
+    return _parse_ctime(timestamp)
 
 class Block: # Creates a block with its own unique hash using the transaction data and previous hash
-    def __init__(self, index, timestamp, data, prev_hash):
+    # __slots__ keeps each field exactly once and drops the per-instance __dict__,
+    # which matters when millions of blocks are kept in memory
+    __slots__ = ("index", "timestamp", "data", "prev_hash", "hash", "hash_format")
+
+    def __init__(self, index, timestamp, data, prev_hash, hash=None, hash_format="json"):
         self.index = index # the position of the block in the chain
-        self.timestamp = timestamp # the time the block was created
+        self.timestamp = timestamp # the time the block was created, in nanoseconds since the epoch (see epoch_ns)
         self.data = data # data: information about the pharmaceutical event (e.g., shipment, location)
         self.prev_hash = prev_hash # hash of the previous block (used to link blocks securely)
+        self.hash_format = hash_format # which entry of HASH_FORMATS the hash is computed with
 
-        # stores the block's content in dictionary form so it can be easily hashed or displayed
-        self.block_info = {
+        # a precomputed hash can be passed in (e.g., by create_blocks) so it isn't computed twice
+        self.hash = self.calcHash() if hash is None else hash
+
+    @property
+    def block_info(self):
+        # the block's content in dictionary form so it can be easily hashed or displayed.
+        # Built on demand instead of being stored, so the fields aren't kept twice
+        return {
             "Index": self.index,
             "Timestamp": self.timestamp,
             "Data": self.data,
             "Previous Hash": self.prev_hash
         }
-        self.hash = self.calcHash()
 
-    def calcHash(self):
+    def calcHash(self, hash_format=None):
         """
-        * Converts the dictionary into a JSON-formatted string — a standardized way to represent data.
-           - dumps = "dump to string"
-           - sorts_keys=True ensures dictionary keys are always in the same order, which is crucial since
+        * Turns the block's fields into bytes using its hash format (or the one passed in):
+           - "json" converts the block_info dictionary into a JSON-formatted string with sort_keys=True,
+             which ensures dictionary keys are always in the same order, which is crucial since
              hashing is highly sensitive (even the smallest difference will interfere with the hash)
-           - .encode() turns the string into bytes, which is what the hashing function needs as input
+           - "canon-v1" uses the canonical binary encoding, which is cheaper to produce than sorted JSON
         """
-        block_str = json.dumps(self.block_info, sort_keys=True).encode() #
-        return hashlib.sha256(block_str).hexdigest() # generates a hash using Secure Hash Algorithm 256-bit
+        block_bytes = HASH_FORMATS[hash_format or self.hash_format](self.index, self.timestamp, self.data, self.prev_hash)
+        return hashlib.sha256(block_bytes).hexdigest() # generates a hash using Secure Hash Algorithm 256-bit
+
+    @property
+    def epoch_ns(self): # the creation time in nanoseconds since the epoch, also for legacy ctime timestamps
+        return epoch_ns(self.timestamp)
+
+    @property
+    def ctime(self): # the creation time in the readable time.ctime() format (e.g., "Tue Apr 14 10:00:00 2025"), for display
+        if type(self.timestamp) is int:
+            return time.ctime(self.timestamp / 1_000_000_000)
+        return self.timestamp
+
+# Binary ledger record layout (all numbers big-endian):
+#   record  = length (4 bytes) + crc32 of payload (4 bytes) + payload
+#   payload = version (1 byte) + index (8 bytes) + hash + previous hash + hash format + timestamp + data
+# The index sits at a fixed spot so a reader can skip records without decoding them.
+# Hashes are stored as raw 32-byte digests (tag "H") when they are SHA-256 hex strings, otherwise as canonical strings.
+# The data dictionary fills the rest of the payload as compact JSON, which is smaller than the canonical
+# encoding and decoded by the json module's C parser.
+# Version 2 records (written with a FieldDictionary) put the dictionary-encoded fields in front of the JSON:
+#   count (1 byte) + for each field: its slot in FieldDictionary.fields (1 byte) + the code of its value (4 bytes)
+_RECORD_HEAD = struct.Struct(">II")
+_RECORD_VERSION = 1
+_RECORD_VERSION_CODED = 2
+_SEGMENT_MAGIC = b"PBSEG\x00\x01\x00" # identifies a segment file, plus its format version
+_SEGMENT_HEAD = struct.Struct(">8sq") # magic + index of the first block in the segment
+_json_decode = json.JSONDecoder().decode # skips json.loads' per-call argument handling
+_OFFSET = struct.Struct(">Q") # one entry of a segment's offset index (.idx): byte offset of a record in the .seg file
+
+class LazyBlock(Block):
+    """
+    A Block that keeps only its header (index, timestamp, previous hash, hash) in memory.
+    Its data is fetched from the ledger the first time it's used, through fetch_data(index)
+    (see PharmaBlockChain.load_headers, which puts a bounded LRU cache in front of the ledger).
+    """
+    __slots__ = ("fetch_data",)
+
+    def __init__(self, index, timestamp, prev_hash, hash, hash_format, fetch_data):
+        self.index = index
+        self.timestamp = timestamp
+        self.prev_hash = prev_hash
+        self.hash = hash
+        self.hash_format = hash_format
+        self.fetch_data = fetch_data
+
+    @property
+    def data(self): # read from the ledger (or the cache) on every access, never kept on the block
+        return self.fetch_data(self.index)
+
+def _pack_hash(block_hash, parts):
+    digest = _digest(block_hash)
+    if digest is None:
+        _canonical(block_hash, parts)
+    else:
+        parts.append(b"H" + digest)
+
+def _unpack_hash(buf, pos):
+    if buf[pos] == 0x48: # "H"
+        return buf[pos + 1:pos + 33].hex(), pos + 33
+    return _decode_canonical(buf, pos)
+
+def encode_record(block, dictionary=None):
+    # a Block -> one binary ledger record (header + payload); with a FieldDictionary, its fields are stored as codes
+    parts = [bytes([_RECORD_VERSION if dictionary is None else _RECORD_VERSION_CODED]), _pack_int(block.index)]
+    _pack_hash(block.hash, parts)
+    _pack_hash(block.prev_hash, parts)
+    _canonical(block.hash_format, parts)
+    _canonical(block.timestamp, parts)
+    data = block.data
+    if dictionary is not None:
+        coded = []
+        rest = dict(data)
+        for slot, field in enumerate(dictionary.fields):
+            value = rest.get(field)
+            if type(value) is str:
+                coded.append(bytes([slot]) + _pack_len(dictionary.code(value)))
+                del rest[field]
+        parts.append(bytes([len(coded)]))
+        parts.extend(coded)
+        data = rest
+    parts.append(json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode())
+    payload = b"".join(parts)
+    return _RECORD_HEAD.pack(len(payload), zlib.crc32(payload)) + payload
+
+def decode_header(payload):
+    # the header fields of one binary ledger record: (index, timestamp, prev_hash, hash, hash_format, where the data starts)
+    if payload[0] != _RECORD_VERSION and payload[0] != _RECORD_VERSION_CODED:
+        raise ValueError(f"Unsupported ledger record version {payload[0]}")
+    index = _unpack_int(payload, 1)[0]
+    block_hash, pos = _unpack_hash(payload, 9)
+    prev_hash, pos = _unpack_hash(payload, pos)
+    hash_format, pos = _decode_canonical(payload, pos)
+    timestamp, pos = _decode_canonical(payload, pos)
+    return index, timestamp, prev_hash, block_hash, hash_format, pos
+
+def decode_data(payload, pos, dictionary=None): # the data dictionary of a binary ledger record, which starts at pos
+    if payload[0] == _RECORD_VERSION:
+        return _json_decode(str(payload[pos:], "utf-8"))
+    if dictionary is None:
+        raise ValueError("This ledger record uses dictionary encoding, but no FieldDictionary was given")
+    fields = dictionary.fields
+    values = dictionary.values
+    data = {}
+    for _ in range(payload[pos]):
+        data[fields[payload[pos + 1]]] = values[_unpack_len(payload, pos + 2)[0]] # the dictionary's shared string
+        pos += 5
+    data.update(_json_decode(str(payload[pos + 1:], "utf-8")))
+    return data
+
+def decode_payload(payload, dictionary=None): # the payload of one binary ledger record -> Block
+    index, timestamp, prev_hash, block_hash, hash_format, pos = decode_header(payload)
+    data = decode_data(payload, pos, dictionary)
+    return Block(index, timestamp, data, prev_hash, block_hash, hash_format)
+
+# data fields whose values repeat across huge numbers of blocks (e.g., "Shipped", "Factory A").
+# batch_id is left out: nearly every batch is new, so a dictionary of them would only keep growing
+INTERNED_FIELDS = ("event", "location", "destination")
+
+# data fields that get an inverted index by default (batch_id always has one, see PharmaBlockChain.trail)
+INDEXED_FIELDS = ("event", "location", "destination")
+
+class FieldDictionary:
+    """
+    Dictionary encoding for a SegmentLog: every distinct string value of the fields in `fields` is stored once,
+    in a fields.dict file next to the segments, and records store a small integer code in its place.
+    * The file is JSON lines: the first line lists the fields, every other line holds one value,
+      and a value's code is its position among those lines (0, 1, 2, ...)
+    * Values are only ever added. New ones are buffered and written out by flush(), which SegmentLog calls
+      before flushing the records that refer to them (a record whose value was lost in a crash is torn anyway)
+    * Opening one only reads the list of fields; the values are read the first time they're needed
+    * Decoded blocks all share the dictionary's string objects, so repeated values cost no extra memory
+    * Hashes are unaffected: they are computed from the decoded data, exactly as before
+    """
+
+    def __init__(self, path, fields=INTERNED_FIELDS, read_only=False):
+        self.path = path
+        self.read_only = read_only # never writes, not even to drop a torn last line
+        self._values = None # code -> value, once loaded
+        self._codes = None # value -> code, once loaded
+        self._file = None
+        self._has_header = False
+        if os.path.exists(path):
+            with open(path, "rb") as dictionary_file:
+                first_line = dictionary_file.readline()
+            if first_line.endswith(b"\n"):
+                fields = json.loads(first_line)
+                self._has_header = True
+        self.fields = tuple(fields)
+
+    @property
+    def values(self):
+        if self._values is None:
+            self._load()
+        return self._values
+
+    @property
+    def codes(self):
+        if self._codes is None:
+            self._load()
+        return self._codes
+
+    def _load(self): # reads every value, dropping a line cut off by a crash
+        self._values = []
+        self._codes = {}
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as dictionary_file:
+            raw = dictionary_file.read()
+        complete = raw[:raw.rfind(b"\n") + 1] # anything after the last line break was cut off by a crash
+        if len(complete) < len(raw) and not self.read_only:
+            os.truncate(self.path, len(complete))
+        lines = complete.splitlines()
+        self._has_header = bool(lines)
+        for line in lines[1:]:
+            value = json.loads(line)
+            self._codes[value] = len(self._values)
+            self._values.append(value)
+
+    def code(self, value): # the code for value, adding it to the dictionary if it's new
+        codes = self.codes
+        code = codes.get(value)
+        if code is None:
+            if self.read_only:
+                raise ValueError(f"{self.path} is read-only, it can't add {value!r}")
+            if self._file is None:
+                self._file = open(self.path, "ab")
+                if not self._has_header:
+                    self._file.write(json.dumps(list(self.fields)).encode() + b"\n")
+                    self._has_header = True
+            self._file.write(json.dumps(value).encode() + b"\n")
+            code = codes[value] = len(self._values)
+            self._values.append(value)
+        return code
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+def _list_segments(directory): # [(first block index, path)] for every segment file in directory, in order
+    found = []
+    for name in os.listdir(directory):
+        if name.endswith(".seg") and name[:-4].isdigit():
+            found.append((int(name[:-4]), os.path.join(directory, name)))
+    return sorted(found)
+
+class SegmentLog:
+    """
+    Append-only binary ledger, stored as a directory of segment files.
+    * Every record holds all of a Block's fields (including index and previous hash), so the chain
+      can be rebuilt and verified from the log alone, and a crc32 checksum catches corrupted records
+    * Records are length-prefixed, so reading them back needs no parsing of text
+    * When the current segment grows past segment_bytes a new one is started. Segment files are named after
+      the index of their first block (e.g., 000000000000.seg), so seeking to a block only opens one segment
+    * Next to every segment is an offset index (.idx) holding the byte offset of each of its records,
+      which lets LedgerReader jump straight to any block
+    * The values of the often-repeated event fields are dictionary-encoded (see FieldDictionary);
+      pass intern_fields=() to store every record as plain JSON instead
+    * CSV (write_chain) is still available as a human-readable export
+    """
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, intern_fields=INTERNED_FIELDS):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        dictionary_path = os.path.join(directory, "fields.dict")
+        self.dictionary = None # an existing dictionary is always used, since the log's records refer to it
+        if intern_fields or os.path.exists(dictionary_path):
+            self.dictionary = FieldDictionary(dictionary_path, intern_fields)
+        self._file = None # the segment currently open for appending
+        self._offsets = None # its offset index
+        self._position = 0 # size of the open segment, tracked here so appends don't need to ask the OS
+        os.makedirs(directory, exist_ok=True)
+
+    def segments(self): # [(first block index, path)] for every segment, in order
+        return _list_segments(self.directory)
+
+    def append(self, block): # writes one block to the end of the log
+        if self._file is None:
+            segments = self.segments()
+            # keep appending to the newest segment if it still has room
+            if segments and os.path.getsize(segments[-1][1]) < self.segment_bytes:
+                self._open_segment(segments[-1][1])
+            else:
+                self._start_segment(block.index)
+        elif self._position >= self.segment_bytes:
+            self.close()
+            self._start_segment(block.index)
+        record = encode_record(block, self.dictionary)
+        self._file.write(record)
+        self._offsets.write(_OFFSET.pack(self._position))
+        self._position += len(record)
+
+    def _start_segment(self, first_index):
+        path = os.path.join(self.directory, f"{first_index:012d}.seg")
+        with open(path, "ab") as segment:
+            segment.write(_SEGMENT_HEAD.pack(_SEGMENT_MAGIC, first_index))
+        self._open_segment(path)
+
+    def _open_segment(self, path):
+        if not self.index_is_current(path):
+            self.rebuild_index(path)
+        self._file = open(path, "ab")
+        self._offsets = open(path[:-4] + ".idx", "ab")
+        self._position = os.path.getsize(path)
+
+    @staticmethod
+    def index_is_current(path):
+        """
+        Checks that a segment's offset index covers every record in it, without reading the whole segment:
+        the last offset in the index plus the size of the record stored there must be the end of the file.
+        (The index can fall behind if the process stopped between writing a record and its offset.)
+        """
+        index_path = path[:-4] + ".idx"
+        if not os.path.exists(index_path):
+            return False
+        entries = os.path.getsize(index_path) // _OFFSET.size
+        segment_size = os.path.getsize(path)
+        if entries == 0:
+            return segment_size == _SEGMENT_HEAD.size
+        with open(index_path, "rb") as offsets, open(path, "rb") as segment:
+            offsets.seek((entries - 1) * _OFFSET.size)
+            last_offset = _OFFSET.unpack(offsets.read(_OFFSET.size))[0]
+            segment.seek(last_offset)
+            head = segment.read(_RECORD_HEAD.size)
+        return len(head) == _RECORD_HEAD.size and last_offset + _RECORD_HEAD.size + _RECORD_HEAD.unpack(head)[0] == segment_size
+
+    def recover(self):
+        """
+        Repairs the log after a crash in the middle of an append, so it can be read and appended to again.
+        Only the newest segment can be damaged, since it's the only one ever written to.
+        * Walks backward through its offset index to the newest record that is complete, passes its checksum,
+          matches its hash and links to the record before it
+        * Then walks forward from there, keeping any complete records whose offsets never made it into the index
+        * Everything after the last good record is moved into a .torn file next to the segment, and the segment
+          and its index are truncated, so the work is proportional to the damaged tail, not the whole log
+        Returns the number of bytes removed.
+        """
+        self.close()
+        segments = self.segments()
+        if not segments:
+            return 0
+        path = segments[-1][1]
+        index_path = path[:-4] + ".idx"
+        size = os.path.getsize(path)
+        if size < _SEGMENT_HEAD.size: # the crash happened while the segment was being created
+            _quarantine(path, 0)
+            os.remove(path)
+            if os.path.exists(index_path):
+                os.remove(index_path)
+            return size
+
+        with open(path, "rb") as segment:
+            def record_at(offset): # the Block stored at offset, or None if it's torn or corrupt
+                segment.seek(offset)
+                head = segment.read(_RECORD_HEAD.size)
+                if len(head) < _RECORD_HEAD.size:
+                    return None, offset
+                length, checksum = _RECORD_HEAD.unpack(head)
+                payload = segment.read(length)
+                if len(payload) < length or zlib.crc32(payload) != checksum:
+                    return None, offset
+                try:
+                    block = decode_payload(payload, self.dictionary)
+                except (ValueError, IndexError): # IndexError: a code the dictionary never got
+                    return None, offset
+                return (block if block.calcHash() == block.hash else None), offset + _RECORD_HEAD.size + length
+
+            offsets = array("Q")
+            if os.path.exists(index_path):
+                with open(index_path, "rb") as index_file:
+                    raw = index_file.read()
+                offsets.frombytes(raw[:len(raw) - len(raw) % _OFFSET.size])
+                if sys.byteorder == "little":
+                    offsets.byteswap() # the index is stored big-endian
+
+            # backward: the newest indexed record that is intact and links to the one before it
+            good_end = _SEGMENT_HEAD.size
+            last = None
+            keep = 0
+            for k in range(len(offsets) - 1, -1, -1):
+                if offsets[k] >= size:
+                    continue
+                block, end = record_at(offsets[k])
+                if block is None:
+                    continue
+                if k > 0:
+                    previous, _ = record_at(offsets[k - 1])
+                    if previous is None or previous.hash != block.prev_hash:
+                        continue
+                good_end, last, keep = end, block, k + 1
+                break
+            del offsets[keep:]
+
+            # forward: complete records that were written but never indexed
+            while good_end < size:
+                block, end = record_at(good_end)
+                if block is None or (last is not None and block.prev_hash != last.hash):
+                    break
+                offsets.append(good_end)
+                good_end, last = end, block
+
+        removed = size - good_end
+        if removed:
+            _quarantine(path, good_end)
+            os.truncate(path, good_end)
+        if sys.byteorder == "little":
+            offsets.byteswap()
+        with open(index_path, "wb") as index_file:
+            index_file.write(offsets.tobytes())
+        return removed
+
+    def rebuild_index(self, path): # rewrites a segment's offset index by scanning the segment
+        with open(path[:-4] + ".idx", "wb") as offsets:
+            for offset, _ in self._records(path):
+                offsets.write(_OFFSET.pack(offset))
+
+    @staticmethod
+    def scan_offsets(path):
+        """
+        The offset index of a segment, built in memory by scanning it, without writing anything.
+        Stops at a torn record at the end (e.g., one a writer is still appending; recover() repairs those).
+        """
+        offsets = bytearray()
+        try:
+            for offset, _ in SegmentLog._records(path):
+                offsets += _OFFSET.pack(offset)
+        except ValueError:
+            pass
+        return bytes(offsets)
+
+    def flush(self):
+        if self.dictionary is not None:
+            self.dictionary.flush() # first, so flushed records never refer to values that aren't on disk
+        if self._file is not None:
+            self._file.flush()
+            self._offsets.flush()
+
+    def close(self):
+        if self.dictionary is not None:
+            self.dictionary.close()
+        if self._file is not None:
+            self._file.close()
+            self._offsets.close()
+            self._file = self._offsets = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def _records(path, start_index=None, offset=None):
+        # yields (offset, payload) for every record in one segment, skipping (without decoding) those before start_index.
+        # offset, if known, is where the first wanted record starts
+        with open(path, "rb") as segment:
+            magic, _ = _SEGMENT_HEAD.unpack(segment.read(_SEGMENT_HEAD.size))
+            if magic != _SEGMENT_MAGIC:
+                raise ValueError(f"{path} is not a ledger segment")
+            if offset is not None:
+                segment.seek(offset)
+            while True:
+                head = segment.read(_RECORD_HEAD.size)
+                if not head:
+                    return
+                if len(head) < _RECORD_HEAD.size:
+                    raise ValueError(f"{path}: truncated record header at byte {segment.tell() - len(head)}")
+                size, checksum = _RECORD_HEAD.unpack(head)
+                payload = segment.read(size)
+                if len(payload) < size:
+                    raise ValueError(f"{path}: truncated record at byte {segment.tell() - len(payload) - len(head)}")
+                offset = segment.tell() - size - len(head)
+                if start_index is not None and _unpack_int(payload, 1)[0] < start_index:
+                    continue
+                if zlib.crc32(payload) != checksum:
+                    raise ValueError(f"{path}: checksum mismatch at byte {offset}")
+                yield offset, payload
+
+    def __iter__(self): # every block in the log, in order
+        return self.iter_from(0)
+
+    def iter_from(self, index): # every block from index onward, opening only the segments that can hold them
+        segments = self.segments()
+        # the last segment whose first block is at or before index is where reading starts
+        first = 0
+        for position, (first_index, _) in enumerate(segments):
+            if first_index <= index:
+                first = position
+        for first_index, path in segments[first:]:
+            offset = None
+            if first_index < index and self.index_is_current(path):
+                # jump straight to the block through the offset index instead of skipping records one by one
+                with open(path[:-4] + ".idx", "rb") as offsets:
+                    offsets.seek((index - first_index) * _OFFSET.size)
+                    entry = offsets.read(_OFFSET.size)
+                if len(entry) < _OFFSET.size:
+                    continue # the block is past the end of this segment
+                offset = _OFFSET.unpack(entry)[0]
+            for _, payload in self._records(path, index if first_index < index else None, offset):
+                yield decode_payload(payload, self.dictionary)
+
+    def read(self, index): # a single block, or None if the log doesn't have it
+        for block in self.iter_from(index):
+            return block if block.index == index else None
+        return None
+
+    def last_block(self): # the newest block in the log, or None if it's empty
+        segments = self.segments()
+        for _, path in reversed(segments): # the newest segment can be empty if a write stopped right after creating it
+            last = None
+            for _, last in self._records(path):
+                pass
+            if last is not None:
+                return decode_payload(last, self.dictionary)
+        return None
+
+class LedgerReader:
+    """
+    Read-only random access to a SegmentLog through memory-mapped files.
+    * Opening is instant: every segment and its offset index (.idx) are mapped into memory, nothing is parsed
+    * Nothing is ever written, so it works on a read-only replica. A missing directory raises FileNotFoundError,
+      and a stale offset index (one that doesn't cover the whole segment) is rebuilt in memory instead of on disk
+    * reader[n] and reader[a:b] find each record through the offset index, so fetching block n never
+      touches the blocks before it; negative indexes and slices work like they do on a list
+    * payload(n) returns a zero-copy memoryview of the record's bytes (release it before calling close)
+    * Every record's crc32 checksum is checked when it is read
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._firsts = [] # index of the first block in each segment
+        self._segments = [] # (segment map, offset index map or bytes, number of records)
+        self._maps = []
+        self._files = []
+        segments = _list_segments(directory)
+        dictionary_path = os.path.join(directory, "fields.dict")
+        # the reader never adds values, and never repairs the file either
+        self.dictionary = FieldDictionary(dictionary_path, read_only=True) if os.path.exists(dictionary_path) else None
+        for first_index, path in segments:
+            if SegmentLog.index_is_current(path):
+                offsets = self._map(path[:-4] + ".idx")
+            else:
+                offsets = SegmentLog.scan_offsets(path)
+            count = len(offsets) // _OFFSET.size if offsets is not None else 0
+            if count == 0:
+                continue
+            self._firsts.append(first_index)
+            self._segments.append((self._map(path), offsets, count))
+        self._length = self._firsts[-1] + self._segments[-1][2] if self._firsts else 0
+
+    def __len__(self):
+        return self._length
+
+    def payload(self, n): # the raw payload bytes of block n, without copying
+        if n < 0:
+            n += self._length
+        if not 0 <= n < self._length:
+            raise IndexError(f"block {n} is not in the ledger")
+        position = bisect_right(self._firsts, n) - 1
+        segment, offsets, count = self._segments[position]
+        k = n - self._firsts[position]
+        if k >= count:
+            raise IndexError(f"block {n} is missing from the ledger")
+        offset = _OFFSET.unpack_from(offsets, k * _OFFSET.size)[0]
+        size, checksum = _RECORD_HEAD.unpack_from(segment, offset)
+        start = offset + _RECORD_HEAD.size
+        view = memoryview(segment)[start:start + size]
+        if zlib.crc32(view) != checksum:
+            view.release()
+            raise ValueError(f"{self.directory}: checksum mismatch in block {n}")
+        return view
+
+    def __getitem__(self, n):
+        if isinstance(n, slice):
+            return list(self.iter_range(*n.indices(self._length)))
+        with self.payload(n) as view:
+            return decode_payload(view, self.dictionary)
+
+    def iter_range(self, start, stop, step=1): # yields blocks start, start + step, ... up to (not including) stop
+        for n in range(start, stop, step):
+            with self.payload(n) as view:
+                yield decode_payload(view, self.dictionary)
+
+    def __iter__(self):
+        return self.iter_range(0, self._length)
+
+    def _map(self, path): # path mapped into memory, read-only (None for an empty file, which can't be mapped)
+        if os.path.getsize(path) == 0:
+            return None
+        handle = open(path, "rb")
+        self._files.append(handle)
+        mapped = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mapped)
+        return mapped
+
+    def close(self):
+        for mapped in self._maps:
+            mapped.close()
+        for handle in self._files:
+            handle.close()
+        self._segments = []
+        self._firsts = []
+        self._maps = []
+        self._files = []
+        self._length = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# Compression codecs for ledger archives: name -> (compress, decompress)
+CODECS = {
+    "zlib": (zlib.compress, zlib.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+}
+
+_ARCHIVE_MAGIC = b"PBARC\x00\x01\x00" # identifies a ledger archive, plus its format version
+_FRAME_ENTRY = struct.Struct(">qQI") # frame index entry: first block index, file offset, compressed size
+_ARCHIVE_FOOTER = struct.Struct(">QI8s") # offset of the frame index, number of frames, magic
+
+class CompressedLedger:
+    """
+    Read-only, compressed copy of a ledger for archiving and replicating to other sites (see write_archive).
+    * Blocks are stored as binary ledger records (the same ones SegmentLog uses), frame_blocks records at a time,
+      and every frame is compressed on its own with one of CODECS
+    * A frame index at the end of the file holds where each frame starts, so ledger[n] decompresses
+      only the one frame holding block n, never the whole file
+    * The most recently used frame stays decompressed, so reading blocks in order decompresses each frame once
+    * Layout: magic, codec name (length-prefixed), frame_blocks, the frames, the frame index, then a footer
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._file.seek(-_ARCHIVE_FOOTER.size, os.SEEK_END)
+        index_offset, frame_count, magic = _ARCHIVE_FOOTER.unpack(self._file.read(_ARCHIVE_FOOTER.size))
+        self._file.seek(0)
+        head = self._file.read(len(_ARCHIVE_MAGIC) + 4)
+        if magic != _ARCHIVE_MAGIC or head[:len(_ARCHIVE_MAGIC)] != _ARCHIVE_MAGIC:
+            raise ValueError(f"{path} is not a ledger archive")
+        name_length = _unpack_len(head, len(_ARCHIVE_MAGIC))[0]
+        self.codec = self._file.read(name_length).decode()
+        if self.codec not in CODECS:
+            raise ValueError(f"{path}: unknown codec {self.codec!r}")
+        self.frame_blocks = _unpack_len(self._file.read(4))[0]
+        self._decompress = CODECS[self.codec][1]
+
+        self._file.seek(index_offset)
+        entries = self._file.read(frame_count * _FRAME_ENTRY.size)
+        self._firsts = array("q") # index of the first block in each frame
+        self._offsets = array("Q")
+        self._sizes = array("I")
+        for first_index, offset, size in _FRAME_ENTRY.iter_unpack(entries):
+            self._firsts.append(first_index)
+            self._offsets.append(offset)
+            self._sizes.append(size)
+        self._cached = (None, None) # (frame number, [payloads]) of the last frame read
+        self._length = self._firsts[-1] + len(self.frame(frame_count - 1)) if frame_count else 0
+
+    @classmethod
+    def write(cls, path, blocks, codec="zlib", frame_blocks=1024):
+        """
+        Writes blocks (any iterable, consumed lazily) to a new archive at path and returns it opened.
+        The archive is written under a temporary name and then renamed, so a crash never leaves half of one.
+        """
+        if codec not in CODECS:
+            raise ValueError(f"Unknown codec {codec!r}, expected one of {sorted(CODECS)}")
+        compress = CODECS[codec][0]
+        temp_path = path + ".tmp"
+        entries = []
+        with open(temp_path, "wb") as archive:
+            name = codec.encode()
+            archive.write(_ARCHIVE_MAGIC + _pack_len(len(name)) + name + _pack_len(frame_blocks))
+            offset = archive.tell()
+            frame = []
+            first_index = None
+
+            def flush():
+                nonlocal offset
+                compressed = compress(b"".join(frame))
+                archive.write(compressed)
+                entries.append(_FRAME_ENTRY.pack(first_index, offset, len(compressed)))
+                offset += len(compressed)
+                frame.clear()
+
+            for block in blocks:
+                if not frame:
+                    first_index = block.index
+                frame.append(encode_record(block))
+                if len(frame) == frame_blocks:
+                    flush()
+            if frame:
+                flush()
+            archive.write(b"".join(entries))
+            archive.write(_ARCHIVE_FOOTER.pack(offset, len(entries), _ARCHIVE_MAGIC))
+            archive.flush()
+            os.fsync(archive.fileno())
+        os.replace(temp_path, path)
+        _fsync_directory(os.path.dirname(path))
+        return cls(path)
+
+    def __len__(self):
+        return self._length
+
+    def frame(self, k): # the record payloads of frame k, decompressed (cached until another frame is read)
+        if self._cached[0] == k:
+            return self._cached[1]
+        self._file.seek(self._offsets[k])
+        raw = self._decompress(self._file.read(self._sizes[k]))
+        payloads = []
+        position = 0
+        while position < len(raw):
+            size, checksum = _RECORD_HEAD.unpack_from(raw, position)
+            payload = raw[position + _RECORD_HEAD.size:position + _RECORD_HEAD.size + size]
+            if zlib.crc32(payload) != checksum:
+                raise ValueError(f"{self.path}: checksum mismatch in frame {k}")
+            payloads.append(payload)
+            position += _RECORD_HEAD.size + size
+        self._cached = (k, payloads)
+        return payloads
+
+    def __getitem__(self, n):
+        if isinstance(n, slice):
+            return [self[i] for i in range(*n.indices(self._length))]
+        if n < 0:
+            n += self._length
+        if not 0 <= n < self._length:
+            raise IndexError(f"block {n} is not in the archive")
+        k = bisect_right(self._firsts, n) - 1
+        return decode_payload(self.frame(k)[n - self._firsts[k]])
+
+    def __iter__(self):
+        for k in range(len(self._firsts)):
+            for payload in self.frame(k):
+                yield decode_payload(payload)
+
+    def close(self):
+        self._file.close()
+        self._cached = (None, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def _fsync_directory(path): # makes a rename inside a directory survive a power cut (no-op where unsupported)
+    if hasattr(os, "O_DIRECTORY"):
+        descriptor = os.open(path or ".", os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(descriptor)
+        finally:
+            os.close(descriptor)
+
+class WriteAheadLog:
+    """
+    Journal that makes create_block durable: a block is on disk before create_block returns.
+    * Records use the same binary format as SegmentLog (length + crc32 + payload)
+    * Group commit: appends are written straight away, but the disk sync (fsync, the slow part) is done by a
+      background thread for a whole batch at once. A batch is synced when it reaches max_batch blocks or when
+      its first block has waited max_delay seconds, whichever comes first, so many threads appending
+      at the same time (or one bulk create_blocks call) share a single fsync
+    * A record cut off by a crash is detected with the length and checksum, and dropped when the log is reopened
+    * If a sync fails (e.g., the disk is full or gone), the error is raised in every waiting and later caller,
+      since none of the unsynced blocks can be promised to be on disk
+    * After checkpoint() the journal only holds blocks newer than the ledger, so it has to be opened together
+      with that ledger: PharmaBlockChain.open(ledger, wal=...) or load(ledger, wal=...)
+    * syncs counts the fsyncs done so far, which shows how well appends are being grouped
+    """
+
+    def __init__(self, path, max_batch=256, max_delay=0.002):
+        self.path = path
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.syncs = 0
+
+        good_end = self._scan()[1]
+        if os.path.exists(path) and os.path.getsize(path) > good_end:
+            os.truncate(path, good_end) # drop a torn record left by a crash before appending after it
+        self._file = open(path, "ab")
+
+        self._cond = threading.Condition()
+        self._written = 0 # sequence number of the last record written
+        self._durable = 0 # sequence number of the last record known to be on disk
+        self._closed = False
+        self._error = None # the OSError that stopped the sync thread, if any
+        self._thread = threading.Thread(target=self._sync_batches, name="wal-group-commit", daemon=True)
+        self._thread.start()
+
+    def _scan(self):
+        # returns (payloads of every complete record, byte offset where the complete records end)
+        payloads = []
+        if not os.path.exists(self.path):
+            return payloads, 0
+        with open(self.path, "rb") as journal:
+            buf = journal.read()
+        pos = 0
+        while pos + _RECORD_HEAD.size <= len(buf):
+            size, checksum = _RECORD_HEAD.unpack_from(buf, pos)
+            payload = buf[pos + _RECORD_HEAD.size:pos + _RECORD_HEAD.size + size]
+            if len(payload) < size or zlib.crc32(payload) != checksum:
+                break # torn record: everything from here on was never durable
+            payloads.append(payload)
+            pos += _RECORD_HEAD.size + size
+        return payloads, pos
+
+    def replay(self): # every complete block in the journal, in order
+        payloads, _ = self._scan()
+        return [decode_payload(payload) for payload in payloads]
+
+    def append(self, block): # writes a block to the journal; returns a sequence number to pass to wait()
+        record = encode_record(block)
+        with self._cond:
+            if self._closed:
+                raise ValueError("write-ahead log is closed")
+            self._raise_error()
+            self._file.write(record)
+            self._written += 1
+            pending = self._written - self._durable
+            if pending == 1 or pending >= self.max_batch: # a batch just started, or it's full
+                self._cond.notify_all()
+            return self._written
+
+    def wait(self, sequence): # blocks until the record with this sequence number is on disk
+        with self._cond:
+            while self._durable < sequence:
+                self._raise_error()
+                self._cond.wait()
+
+    def _raise_error(self): # raises the error that stopped the sync thread, if there was one (call with _cond held)
+        if self._error is not None:
+            raise OSError(f"{self.path}: the write-ahead log could not be synced to disk ({self._error})") from self._error
+
+    def _sync_batches(self): # background thread: one fsync per batch of appends
+        with self._cond:
+            while True:
+                while self._written == self._durable and not self._closed:
+                    self._cond.wait()
+                if self._written == self._durable: # closed, nothing left to sync
+                    return
+                # give the batch up to max_delay to fill up, unless it's already full
+                deadline = time.monotonic() + self.max_delay
+                while self._written - self._durable < self.max_batch and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                target = self._written
+                try:
+                    self._file.flush()
+                    self._cond.release() # new appends can carry on while the disk syncs
+                    try:
+                        os.fsync(self._file.fileno())
+                    finally:
+                        self._cond.acquire()
+                except OSError as error: # stop here and let every waiter know, instead of leaving them hanging
+                    self._error = error
+                    self._cond.notify_all()
+                    return
+                self._durable = target
+                self.syncs += 1
+                self._cond.notify_all()
+
+    def truncate(self, upto_index):
+        """
+        Drops the journaled blocks up to and including upto_index, once they are safely stored somewhere else
+        (see PharmaBlockChain.checkpoint). Any newer blocks stay in the journal.
+        """
+        with self._cond:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            keep = [payload for payload in self._scan()[0] if _unpack_int(payload, 1)[0] > upto_index]
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "wb") as journal:
+                for payload in keep:
+                    journal.write(_RECORD_HEAD.pack(len(payload), zlib.crc32(payload)) + payload)
+                journal.flush()
+                os.fsync(journal.fileno())
+            self._file.close()
+            os.replace(temp_path, self.path)
+            _fsync_directory(os.path.dirname(self.path))
+            self._file = open(self.path, "ab")
+            self._durable = self._written # everything written so far is on disk now
+            self._cond.notify_all()
+
+    def close(self): # syncs whatever is still pending and stops the background thread
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        self._file.close()
+
+class MemoryStorage(list):
+    """
+    Default storage for PharmaBlockChain: the blocks are simply kept in a Python list.
+    Any other storage backend (e.g., SQLiteStorage) has to behave like this class:
+    len(), indexing with ints (including negative ones) and slices, iteration, append, clear,
+    plus iter_from and commit below.
+    """
+
+    def iter_from(self, start): # blocks from position start onward, without walking the ones before it
+        return map(self.__getitem__, range(start, len(self)))
+
+    def commit(self): # nothing to do, the list is always up to date
+        pass
+
+class SQLiteStorage:
+    """
+    Stores the chain in an SQLite database file instead of memory, so it survives restarts and can be queried.
+    * Every block is a row with indexed columns for its index, hash, batch_id, event, location and destination.
+      The full data dictionary is kept as a JSON blob, so events with extra fields lose nothing
+    * Rows are ordered by their position in the chain, which is what indexing and iteration use
+    * Appends are grouped into one transaction until commit() (PharmaBlockChain commits after every
+      create_block / create_blocks call), so bulk inserts don't pay for a disk sync per block
+    * select() runs ad-hoc queries on the indexed columns
+    """
+
+    COLUMNS = ("batch_id", "event", "location", "destination") # data fields copied into their own indexed columns
+
+    def __init__(self, path):
+        self.path = path
+        # any thread may use the connection. PharmaBlockChain's lock only covers writes (adding blocks, writing ledgers);
+        # reads such as validation, trail or query share the connection without it, which relies on sqlite3 running
+        # SQLite in serialized mode (sqlite3.threadsafety == 3, the default build)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL") # readers don't block the writer
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS blocks (
+                position INTEGER PRIMARY KEY,
+                block_index INTEGER NOT NULL,
+                timestamp,
+                prev_hash TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                hash_format TEXT NOT NULL,
+                batch_id TEXT,
+                event TEXT,
+                location TEXT,
+                destination TEXT,
+                data BLOB NOT NULL
+            )""")
+        for column in ("block_index", "hash") + self.COLUMNS:
+            self.db.execute(f"CREATE INDEX IF NOT EXISTS blocks_{column} ON blocks ({column})")
+        self.db.commit()
+        self._length = self.db.execute("SELECT COUNT(*) FROM blocks").fetchone()[0]
+
+    _SELECT = "SELECT block_index, timestamp, data, prev_hash, hash, hash_format FROM blocks"
+
+    @staticmethod
+    def _block(row): # a database row -> Block
+        block_index, timestamp, data, prev_hash, block_hash, hash_format = row
+        return Block(block_index, timestamp, json.loads(data), prev_hash, block_hash, hash_format)
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            start, stop, step = position.indices(self._length)
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            rows = self.db.execute(f"{self._SELECT} WHERE position >= ? AND position < ? ORDER BY position", (start, stop))
+            return [self._block(row) for row in rows]
+        if position < 0:
+            position += self._length
+        row = self.db.execute(f"{self._SELECT} WHERE position = ?", (position,)).fetchone()
+        if row is None:
+            raise IndexError("chain index out of range")
+        return self._block(row)
+
+    def __iter__(self):
+        return self.iter_from(0)
+
+    def iter_from(self, start): # streams blocks from position start onward
+        rows = self.db.execute(f"{self._SELECT} WHERE position >= ? ORDER BY position", (start,))
+        return map(self._block, rows)
+
+    def append(self, block):
+        data = block.data
+        self.db.execute(
+            "INSERT INTO blocks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (self._length, block.index, block.timestamp, block.prev_hash, block.hash, block.hash_format,
+             *[_sql_value(data.get(column)) for column in self.COLUMNS],
+             json.dumps(data, sort_keys=True).encode()))
+        self._length += 1
+
+    def clear(self):
+        self.db.execute("DELETE FROM blocks")
+        self.db.commit()
+        self._length = 0
+
+    def commit(self):
+        self.db.commit()
+
+    def select(self, positions=None, limit=None, **columns):
+        """
+        Yields the blocks whose indexed columns equal the given values, in chain order, using the database indexes.
+        e.g., storage.select(batch_id="Batch 1", event="Shipped"). Use index= and hash= for those two columns.
+        * A list, tuple or set of values matches any of them (SQL IN)
+        * positions=(start, stop) keeps only the blocks at those chain positions, limit caps the number of blocks
+        """
+        names = {"index": "block_index"}
+        conditions = []
+        values = []
+        for name, value in columns.items():
+            column = names.get(name, name)
+            if column not in ("block_index", "hash") + self.COLUMNS:
+                raise ValueError(f"{name!r} is not an indexed column")
+            if isinstance(value, (list, tuple, set, frozenset)):
+                value = list(value)
+                conditions.append(f"{column} IN ({', '.join('?' * len(value))})")
+                values.extend(map(_sql_value, value))
+            else:
+                conditions.append(f"{column} = ?")
+                values.append(_sql_value(value))
+        if positions is not None:
+            conditions.append("position >= ? AND position < ?")
+            values.extend(positions)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        if limit is not None:
+            where += " ORDER BY position LIMIT ?"
+            values.append(limit)
+        else:
+            where += " ORDER BY position"
+        return map(self._block, self.db.execute(f"{self._SELECT}{where}", values))
+
+    def close(self):
+        self.db.close()
+
+def _sql_value(value): # data values that SQLite can't store directly (e.g., lists) are kept as JSON text
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    return json.dumps(value, sort_keys=True)
+
+def _csv_blocks(ledger_path, hash_format, offset=0, index=0, prev_hash="0"):
+    """
+    Streams the rows of a CSV ledger as Blocks, starting at byte offset (the start of a row).
+    The CSV doesn't store index or previous hash, so those come from the row's position and the hash on the row
+    before it; index and prev_hash say what they are for the first row read.
+    """
+    with open(ledger_path, "rb") as raw:
+        raw.seek(offset)
+        csv_ledger = io.TextIOWrapper(raw, newline="")
+        for row_number, row in enumerate(csv.reader(csv_ledger), start=1):
+            if row == ["Timestamp", "Data", "Hash"]: # header
+                continue
+            if len(row) != 3:
+                raise ValueError(f"{ledger_path} row {row_number}: expected 3 columns, found {len(row)}")
+            timestamp, data_string, block_hash = row
+            if timestamp.isdigit(): # epoch nanoseconds; legacy rows hold a ctime string, which is kept as it is
+                timestamp = int(timestamp)
+            yield Block(index, timestamp, json.loads(data_string), prev_hash, block_hash, hash_format)
+            index += 1
+            prev_hash = block_hash
+
+def _jsonl_blocks(path, hash_format):
+    # Streams the lines of a JSON Lines ledger written by write_jsonl as Blocks (hash_format is for lines without one)
+    with open(path, "r", encoding="utf-8") as jsonl_ledger:
+        for line_number, line in enumerate(jsonl_ledger, start=1):
+            try:
+                record = json.loads(line)
+                yield Block(record["index"], record["timestamp"], record["data"], record["prev_hash"],
+                            record["hash"], record.get("hash_format", hash_format))
+            except (ValueError, KeyError, TypeError) as error:
+                raise ValueError(f"{path} line {line_number}: not a ledger entry ({error})") from None
+
+def _quarantine(path, start): # copies the bytes of path from start onward into path + ".torn", for inspection
+    with open(path, "rb") as damaged, open(path + ".torn", "ab") as torn:
+        damaged.seek(start)
+        torn.write(damaged.read())
+
+def _is_complete_row(line): # whether one line of a CSV ledger is a whole, well-formed row (or the header)
+    try:
+        row = next(csv.reader([line.decode()]))
+    except (UnicodeDecodeError, csv.Error, StopIteration):
+        return False
+    if row == ["Timestamp", "Data", "Hash"]:
+        return True
+    if len(row) != 3 or _digest(row[2]) is None:
+        return False
+    try:
+        return isinstance(json.loads(row[1]), dict)
+    except ValueError:
+        return False
+
+def recover_ledger(ledger_path, chunk_size=64 * 1024):
+    """
+    Repairs a CSV ledger after a crash in the middle of write_chain, which can leave a partial row at the end.
+    * Reads the file backward in chunks, from the end, until it finds the last row that is complete
+      (ends with a line break, has a timestamp, a JSON data dictionary and a 64-character hash).
+      Only the damaged tail is read, so this is fast even on a huge ledger
+    * The torn bytes after that row are moved into ledger_path + ".torn" and the ledger is truncated
+    * The CSV doesn't store block indexes, so hashes can't be recomputed here; load() re-verifies them
+      (and the links) when the ledger is read back
+    Returns the number of bytes removed.
+    """
+    size = os.path.getsize(ledger_path)
+    with open(ledger_path, "rb") as ledger:
+        buf = b"" # the tail of the file read so far
+        buf_start = size # file offset of buf[0]
+
+        def newline_before(limit): # file offset of the last line break before offset limit, or -1
+            nonlocal buf, buf_start
+            while True:
+                found = buf.rfind(b"\n", 0, limit - buf_start)
+                if found >= 0 or buf_start == 0:
+                    return buf_start + found if found >= 0 else -1
+                read = min(chunk_size, buf_start) # read one more chunk, further back
+                buf_start -= read
+                ledger.seek(buf_start)
+                buf = ledger.read(read) + buf
+
+        end = size # candidate rows end just before this offset
+        good_end = 0
+        while end > 0:
+            newline = newline_before(end)
+            if newline < 0:
+                break # not a single complete row left
+            if newline != end - 1:
+                end = newline + 1 # drop the partial row after the last line break
+                continue
+            row_start = newline_before(newline) + 1
+            if _is_complete_row(buf[row_start - buf_start:end - buf_start]):
+                good_end = end
+                break
+            end = row_start
+
+    removed = size - good_end
+    if removed:
+        _quarantine(ledger_path, good_end)
+        os.truncate(ledger_path, good_end)
+    return removed
+
+_SNAPSHOT_MAGIC = b"PBSNAP\x00\x01" # identifies a snapshot file, plus its format version
+
+def _check_data(data): # rejects a new block's data before it's journaled or added to the chain
+    if not isinstance(data, dict):
+        raise TypeError(f"block data must be a dict, not {type(data).__name__}")
+
+def _indexable(value): # whether a data value gets indexed (trails, posting lists, graph); lists and dictionaries don't
+    return value is not None and isinstance(value, (str, int, float))
+
+def intersect_postings(*postings):
+    """
+    AND of sorted posting lists (arrays of block indexes): the indexes found in every one of them, still sorted.
+    Starts from the shortest list, so the cost depends mostly on the most selective condition. Against a much
+    longer list each candidate is found by binary search instead of walking the whole list.
+    """
+    if not postings:
+        return array("q")
+    postings = sorted(postings, key=len)
+    result = array("q", postings[0])
+    for other in postings[1:]:
+        if not result:
+            break
+        matched = array("q")
+        if len(other) > 8 * len(result):
+            low = 0
+            for index in result:
+                low = bisect_left(other, index, low)
+                if low == len(other):
+                    break
+                if other[low] == index:
+                    matched.append(index)
+        else:
+            position, end = 0, len(other)
+            for index in result:
+                while position < end and other[position] < index:
+                    position += 1
+                if position == end:
+                    break
+                if other[position] == index:
+                    matched.append(index)
+        result = matched
+    return result
+
+def union_postings(*postings): # OR of sorted posting lists: the indexes found in any of them, sorted, without repeats
+    if len(postings) == 1:
+        return array("q", postings[0])
+    return array("q", sorted(set().union(*postings)))
+
+class SupplyGraph:
+    """
+    The physical supply network, built from the events on the chain: every block whose data has a location and
+    a destination is a movement along the directed edge location -> destination.
+    * Updated as each block is indexed (see PharmaBlockChain.graph), so it's never rebuilt from the chain
+    * successors / predecessors are adjacency lists (node -> {neighbour: number of movements})
+    * Per batch, it keeps the nodes it passed through and how many times it used each edge;
+      per edge, which batches crossed it and how many times
+    """
 
-class PharmaBlockChain:
     def __init__(self):
-        self.chain = [self.generate_genesis_block()] # holds all the blocks
+        self.successors = {} # node -> {next node: movements}
+        self.predecessors = {} # node -> {previous node: movements}
+        self.edge_batches = {} # (location, destination) -> {batch_id: movements}, batches in the order they first crossed it
+        self.batch_edges = {} # batch_id -> {(location, destination): movements}
+        self.batch_nodes = {} # batch_id -> {node: events there}, nodes in the order the batch reached them
+        self._edges = {}
+
+    def add(self, data): # records the movement (if any) described by one block's data
+        location = data.get("location")
+        if type(location) is not str:
+            return
+        destination = data.get("destination")
+        batch_id = data.get("batch_id")
+        if not _indexable(batch_id):
+            batch_id = None # e.g., a list of batches; the movement still counts, but not for any one batch
+        if batch_id is not None:
+            nodes = self.batch_nodes.get(batch_id)
+            if nodes is None:
+                nodes = self.batch_nodes[batch_id] = {}
+            nodes[location] = nodes.get(location, 0) + 1
+        if type(destination) is not str:
+            return
+
+        successors = self.successors.get(location)
+        if successors is None:
+            successors = self.successors[location] = {}
+        successors[destination] = successors.get(destination, 0) + 1
+        predecessors = self.predecessors.get(destination)
+        if predecessors is None:
+            predecessors = self.predecessors[destination] = {}
+        predecessors[location] = predecessors.get(location, 0) + 1
+
+        if batch_id is not None:
+            edge = (location, destination)
+            batches = self.edge_batches.get(edge)
+            if batches is None:
+                batches = self.edge_batches[edge] = {}
+                self._edges[edge] = edge
+            edge = self._edges[edge] # one tuple per edge, shared by every batch that crossed it
+            batches[batch_id] = batches.get(batch_id, 0) + 1
+            edges = self.batch_edges.get(batch_id)
+            if edges is None:
+                edges = self.batch_edges[batch_id] = {}
+            edges[edge] = edges.get(edge, 0) + 1
+            if destination not in nodes:
+                nodes[destination] = 0 # on its way there, though no event was recorded there yet
+
+    def path(self, batch_id): # every node the batch passed through (or was sent to), in the order it reached them
+        return list(self.batch_nodes.get(batch_id, ()))
+
+    def edges(self, batch_id): # {(location, destination): movements} of one batch
+        return dict(self.batch_edges.get(batch_id, {}))
+
+    def batches_across(self, location, destination): # {batch_id: movements} of every batch that crossed the edge
+        return dict(self.edge_batches.get((location, destination), {}))
+
+    def reachable(self, start, max_hops=None, upstream=False):
+        """
+        Breadth-first search from start: yields (node, hops) for every node a product could have been moved to
+        from start, nearest first, as they are found (start itself is not included).
+        * max_hops stops the search that many edges away from start
+        * upstream=True follows edges backward instead, to find every node that could have supplied start
+        """
+        adjacency = self.predecessors if upstream else self.successors
+        seen = {start}
+        frontier = deque([(start, 0)])
+        while frontier:
+            node, hops = frontier.popleft()
+            if max_hops is not None and hops >= max_hops:
+                continue
+            for neighbour in adjacency.get(node, ()):
+                if neighbour not in seen:
+                    seen.add(neighbour)
+                    yield neighbour, hops + 1
+                    frontier.append((neighbour, hops + 1))
+
+class Query:
+    """
+    A composable, lazily evaluated question about a chain's blocks (see PharmaBlockChain.query), e.g.
+        chain.query().where(event="Shipped", location="Warehouse X").between(t0, t1).limit(100)
+    * Every method returns a new Query, so a partial query can be reused and refined
+    * Iterating runs it: the most selective index available (hash, batch / field posting lists, or the
+      times array) gives the candidate blocks, and every other condition is checked on them one by one,
+      in a generator, so nothing is fetched past what the caller consumes (or past the limit)
+    * On SQLiteStorage, the conditions on its indexed columns, the time window and the limit are pushed
+      down into one SQL query instead
+    * explain() describes the plan without running it
+    """
+
+    def __init__(self, chain):
+        self._chain = chain
+        self._fields = {} # data field (or "hash") -> value, or a list / tuple / set of values (any of them)
+        self._window = None # (t0, t1) in epoch nanoseconds
+        self._predicates = [] # functions of a block, which must all return true
+        self._limit = None
+
+    def _with(self, **changes): # a copy of this query with some attributes replaced
+        query = Query(self._chain)
+        query._fields = dict(self._fields)
+        query._window = self._window
+        query._predicates = list(self._predicates)
+        query._limit = self._limit
+        for name, value in changes.items():
+            setattr(query, "_" + name, value)
+        return query
+
+    def where(self, *predicates, **fields):
+        """
+        Keeps the blocks whose data matches every field (a list, tuple or set of values matches any of them),
+        and for which every predicate (a function of the block) returns true. hash= matches the block's hash
+        (again, a list, tuple or set of hashes matches any of them).
+        """
+        return self._with(fields={**self._fields, **fields}, predicates=self._predicates + list(predicates))
+
+    def between(self, t0, t1): # keeps the blocks created in [t0, t1) (epoch nanoseconds, see blocks_between)
+        if self._window is not None: # narrowing an existing window
+            t0, t1 = max(t0, self._window[0]), min(t1, self._window[1])
+        return self._with(window=(t0, t1))
+
+    def limit(self, count): # stops after count blocks
+        return self._with(limit=count if self._limit is None else min(count, self._limit))
+
+    def _plan(self):
+        """
+        (candidate positions, name of the index used, the field conditions left to check on each block).
+        Candidate positions come from whichever index narrows the chain down the most.
+        """
+        chain = self._chain
+        fields = dict(self._fields)
+        options = [] # (number of candidates, the candidates as one or more sorted lists of positions, index name)
+        if "hash" in fields: # at most one block per hash, so this is nearly always the smallest
+            value = fields["hash"]
+            values = value if isinstance(value, (list, tuple, set, frozenset)) else (value,)
+            positions = {chain.hashes.get(_digest(v) if isinstance(v, str) else None) for v in values}
+            positions.discard(None)
+            options.append((len(positions), [sorted(positions)], "hash"))
+        for field, value in fields.items():
+            if field in chain.postings:
+                values = value if isinstance(value, (list, tuple, set, frozenset)) else (value,)
+                found = [chain.posting(field, v) for v in values]
+                options.append((sum(map(len, found)), found, field))
+        if self._window is not None:
+            positions = chain.time_range(*self._window)
+            options.append((len(positions), [positions], "time"))
+        if not options:
+            return range(len(chain.chain)), "scan", fields
+        size, found, name = min(options, key=lambda option: option[0])
+        fields.pop(name, None)
+        return (found[0] if len(found) == 1 else union_postings(*found)), name, fields
+
+    def _pushdown(self):
+        # the SQL select() arguments for SQLiteStorage, and the field conditions it can't check itself
+        storage = self._chain.chain
+        columns = {}
+        rest = {}
+        for field, value in self._fields.items():
+            if field == "hash" or field in storage.COLUMNS:
+                columns[field] = value
+            else:
+                rest[field] = value
+        positions = None
+        if self._window is not None:
+            found = self._chain.time_range(*self._window)
+            if isinstance(found, range):
+                positions = (found.start, found.stop)
+            else: # the times aren't sorted, so the window is checked block by block
+                rest["time"] = self._window
+        limit = self._limit if not rest and not self._predicates else None
+        return columns, positions, limit, rest
+
+    def explain(self): # how the query would run, e.g. "index location (120 candidates), then check event, time"
+        if isinstance(self._chain.chain, SQLiteStorage):
+            columns, positions, limit, rest = self._pushdown()
+            pushed = list(columns) + (["time"] if positions is not None else []) + (["limit"] if limit is not None else [])
+            plan = f"sqlite select on {', '.join(pushed) or 'all blocks'}"
+            checks = list(rest)
+        else:
+            positions, name, rest = self._plan()
+            plan = "full scan" if name == "scan" else f"index {name}"
+            plan += f" ({len(positions)} candidates)"
+            checks = list(rest) + (["time"] if self._window is not None and name != "time" else [])
+        checks += ["predicate"] * len(self._predicates)
+        return plan + (f", then check {', '.join(checks)}" if checks else "")
+
+    def __iter__(self):
+        return self._run()
+
+    def _run(self):
+        chain = self._chain
+        remaining = self._limit
+        if remaining is not None and remaining <= 0:
+            return
+        times = chain.times
+        if isinstance(chain.chain, SQLiteStorage):
+            columns, positions, limit, rest = self._pushdown()
+            candidates = chain.chain.select(positions, limit, **columns)
+            window = rest.pop("time", None) # only if the pushdown couldn't handle it
+        else:
+            positions, name, rest = self._plan()
+            window = None if name == "time" else self._window # the time index only returns blocks inside the window
+            if window is not None: # checked on the times array, before the block is even fetched
+                t0, t1 = window
+                positions = (position for position in positions if t0 <= times[position] < t1)
+                window = None
+            candidates = map(chain.chain.__getitem__, positions)
+        hash_value = rest.pop("hash", None) # checked on the block itself, hash isn't a data field
+        if hash_value is not None:
+            hashes = set(hash_value) if isinstance(hash_value, (list, tuple, set, frozenset)) else {hash_value}
+        conditions = [(field, value, isinstance(value, (list, tuple, set, frozenset))) for field, value in rest.items()]
+        predicates = self._predicates
+
+        for block in candidates:
+            if window is not None and not window[0] <= times[block.index] < window[1]:
+                continue
+            if hash_value is not None and block.hash not in hashes:
+                continue
+            if conditions:
+                data = block.data
+                if not all((data.get(field) in value) if several else (data.get(field) == value)
+                           for field, value, several in conditions):
+                    continue
+            if predicates and not all(predicate(block) for predicate in predicates):
+                continue
+            yield block
+            if remaining is not None:
+                remaining -= 1
+                if remaining == 0:
+                    return
+
+    def first(self): # the first matching block, or None
+        return next(iter(self.limit(1)), None)
+
+    def count(self): # the number of matching blocks
+        return sum(1 for _ in self)
+
+class PharmaBlockChain:
+    def __init__(self, hash_format="json", legacy_json=False, storage=None, wal=None,
+                 snapshot_path=None, snapshot_every=100_000, intern_fields=INTERNED_FIELDS,
+                 index_fields=INDEXED_FIELDS):
+        """
+        * hash_format picks how new blocks are hashed (a key of HASH_FORMATS)
+        * legacy_json=True is a compatibility mode: blocks whose hash was computed with the original
+          JSON format still verify, even when the chain itself hashes new blocks another way
+        * storage is where the blocks live: a MemoryStorage list by default, or e.g. SQLiteStorage("chain.db").
+          If the storage already holds blocks, the chain continues from them instead of starting a new genesis block
+        * wal is an optional WriteAheadLog. With it every new block is journaled and synced to disk (in groups)
+          before create_block returns, and blocks found in the journal are replayed when the chain starts.
+          Once checkpoint() has moved the journal's blocks into a ledger, start from that ledger instead:
+          PharmaBlockChain.open(ledger, wal=...)
+        * snapshot_path turns on periodic snapshots (see save_snapshot): after write_chain or write_segments,
+          a new snapshot is saved once snapshot_every blocks have been added since the last one
+        * intern_fields are the data fields whose values repeat across many blocks (event, batch_id, ...).
+          Every block shares one string object per distinct value, and write_segments dictionary-encodes them
+        * index_fields are the data fields that get an inverted index (see matching), on top of batch_id
+        """
+        if hash_format not in HASH_FORMATS:
+            raise ValueError(f"Unknown hash format {hash_format!r}, expected one of {sorted(HASH_FORMATS)}")
+        self.hash_format = hash_format
+        self.legacy_json = legacy_json
+        self.wal = wal
+        self.snapshot_path = snapshot_path
+        self.snapshot_every = snapshot_every
+        self.intern_fields = tuple(intern_fields)
+        self.index_fields = tuple(field for field in index_fields if field != "batch_id")
+        self._snapshot_length = 0 # chain length at the last snapshot
+        # keeps threads that add blocks at the same time from linking to the same block, and blocks from being added
+        # while the chain is written out; reentrant, since checkpoint holds it around write_chain
+        self._lock = threading.RLock()
+
+        self.chain = MemoryStorage() if storage is None else storage # holds all the blocks
+        self._open()
+
+        # ledger_path -> (index, hash) of the last block already appended to that file.
+        # Lets write_chain append only the new tail instead of the whole chain every call.
+        self.persisted = {}
+
+        # validation mode -> (index, hash) of the last block that mode has verified.
+        # Later validations only check the blocks appended after it.
+        self.verified = {}
+
+        # CSV ledger_path -> size of the file after this chain last wrote (or read) it,
+        # so a snapshot knows where the rows it doesn't cover start
+        self.ledger_offsets = {}
+
+        # directory -> the SegmentLog write_segments keeps open for it
+        self.segment_logs = {}
+
+        # set by load_headers: the ledger that lazily loaded blocks read their data from, and the LRU cache in front of it
+        self.payloads = None
+        self.payload_cache = None
+
+    @classmethod
+    def load(cls, ledger_path, verify=True, **options):
+        """
+        Rebuilds a chain from a CSV ledger written by write_chain, so the service can restart without losing history.
+        * The file is streamed one row at a time, so memory use is just the chain itself
+        * Blocks get back their original timestamps and hashes. The CSV doesn't store index or previous hash,
+          so those come from the row's position and the hash on the row before it
+        * verify=True recomputes every hash while loading (which also proves the links, since the previous hash
+          is part of what gets hashed) and raises a ValueError at the first block that doesn't match
+        * options are passed on to PharmaBlockChain (e.g., hash_format, legacy_json)
+        """
+        chain = cls._for_loading(options)
+        chain._load_blocks(_csv_blocks(ledger_path, chain.hash_format), ledger_path, verify)
+        chain.ledger_offsets[ledger_path] = os.path.getsize(ledger_path)
+        return chain
+
+    @classmethod
+    def open(cls, path, verify=True, **options):
+        """
+        Safe restart after a crash or power loss: repairs a torn tail, then loads the ledger.
+        * path is a directory holding a SegmentLog, or a CSV ledger file
+        * A ledger that doesn't exist yet gives a brand new chain
+        """
+        if os.path.isdir(path):
+            SegmentLog(path).recover()
+            return cls.load_segments(path, verify, **options)
+        if os.path.exists(path):
+            recover_ledger(path)
+            return cls.load(path, verify, **options)
+        return cls(**options)
+
+    @classmethod
+    def load_jsonl(cls, path, verify=True, **options):
+        """
+        Rebuilds a chain from a JSON Lines ledger written by write_jsonl (see load for verify and options).
+        Lines are read one at a time, and every block must sit at its own index and link to the one before it.
+        """
+        chain = cls._for_loading(options)
+        chain._load_blocks(_jsonl_blocks(path, chain.hash_format), path, verify)
+        chain.ledger_offsets[path] = os.path.getsize(path)
+        return chain
+
+    @classmethod
+    def load_segments(cls, directory, verify=True, **options):
+        # Rebuilds a chain from a binary SegmentLog written by write_segments (see load for verify and options)
+        chain = cls._for_loading(options)
+        return chain._load_blocks(iter(SegmentLog(directory)), directory, verify)
+
+    @classmethod
+    def load_headers(cls, directory, cache_size=4096, verify=False, **options):
+        """
+        Opens a SegmentLog written by write_segments keeping only block headers in memory.
+        * Linking, validation(mode="links"), last_block and the hash index only need index, timestamp,
+          previous hash and hash, so those are all each loaded block keeps (see LazyBlock)
+        * A block's data is read from the memory-mapped ledger when it's used, through an LRU cache that holds
+          the data of at most cache_size blocks, so old payloads that nobody asks for never take up memory
+        * Each payload is read once while loading to build the batch trails and inverted indexes; it isn't kept afterwards
+        * Every block's previous hash is the same string object as the hash of the block before it,
+          which saves keeping each hash twice
+        * verify=True recomputes every hash while loading (reading every payload once)
+        * New blocks created afterwards are ordinary Blocks until the chain is reloaded
+        """
+        chain = cls._for_loading(options)
+        reader = LedgerReader(directory)
+
+        def read_data(index):
+            with reader.payload(index) as view:
+                return decode_data(view, decode_header(view)[5], reader.dictionary)
+
+        fetch_data = functools.lru_cache(maxsize=cache_size)(read_data)
+        chain.payloads = reader # kept open for as long as the chain uses it
+        chain.payload_cache = fetch_data # fetch_data.cache_info() shows how well the cache is doing
+
+        def headers():
+            previous = None
+            for n in range(len(reader)):
+                with reader.payload(n) as view:
+                    index, timestamp, prev_hash, block_hash, hash_format, _ = decode_header(view)
+                if previous is not None and prev_hash == previous.hash:
+                    prev_hash = previous.hash # share one string between the two blocks
+                previous = LazyBlock(index, timestamp, prev_hash, block_hash, hash_format, fetch_data)
+                yield previous
+
+        return chain._load_blocks(headers(), directory, verify)
+
+    @classmethod
+    def load_archive(cls, path, verify=True, **options):
+        # Rebuilds a chain from a CompressedLedger written by write_archive (see load for verify and options)
+        chain = cls._for_loading(options)
+        with CompressedLedger(path) as archive:
+            return chain._load_blocks(iter(archive), path, verify)
+
+    @classmethod
+    def _for_loading(cls, options):
+        # an empty chain to load a ledger into; its write-ahead log is replayed after the ledger, not before
+        wal = options.pop("wal", None)
+        chain = cls(**options)
+        chain.wal = wal
+        return chain
+
+    def _load_blocks(self, blocks, source, verify):
+        """
+        Replaces this chain's contents with blocks streamed from source.
+        * Every block must sit at its own index and link to the block before it
+        * verify=True also recomputes every hash
+        * An empty source starts the chain as if it were new
+        """
+        blocks = iter(blocks)
+        first = next(blocks, None)
+        self._clear() # the ledger has its own genesis block
+        if first is None:
+            self._open()
+            return self
+
+        self._extend_loaded(first, blocks, source, verify)
+        last = self.chain[-1]
+        if self.wal is not None:
+            self._replay_wal() # blocks created after the ledger was last written
+        self.persisted[source] = (last.index, last.hash) # everything loaded is already on disk
+        if verify:
+            self.verified["full"] = self.verified["links"] = (last.index, last.hash)
+        return self
+
+    def _extend_loaded(self, first, blocks, source, verify):
+        # appends blocks read from source (first, then the rest of blocks), checking that each one continues the chain
+        previous = self.chain[-1] if len(self.chain) else None
+        for block in itertools.chain((first,), blocks):
+            if block.index != len(self.chain):
+                raise ValueError(f"{source}: expected block {len(self.chain)}, found block {block.index}")
+            if previous is not None and block.prev_hash != previous.hash:
+                raise ValueError(f"{source}: block {block.index} does not link to block {previous.index}")
+            if verify and not self.verify_block(block):
+                raise ValueError(f"{source}: block {block.index} does not match its hash")
+            self._add_block(block)
+            previous = block
+        self.chain.commit()
+
+    def _open(self):
+        # indexes the blocks already in storage, replays the write-ahead log, and starts with a genesis block if still empty
+        self._clear_indexes()
+        for block in self.chain:
+            self._index_block(block)
+        if self.wal is not None:
+            self._replay_wal()
+        if not len(self.chain):
+            genesis = self.generate_genesis_block()
+            self._journal(genesis)
+            self._add_block(genesis)
+            self.chain.commit()
+
+    def _clear(self): # empties the chain and everything derived from it
+        self.chain.clear()
+        self._clear_indexes()
+
+    def _clear_indexes(self):
+        self.trails = {} # batch_id -> indexes of that batch's blocks, in chain order (see trail)
+        # field -> value -> indexes of the blocks with that value, in chain order (see matching).
+        # The batch_id posting lists are the trails themselves.
+        self.postings = {field: {} for field in self.index_fields}
+        self.postings["batch_id"] = self.trails
+        # raw 32-byte digest -> index of the block with that hash (see get_by_hash).
+        # Raw digests are about half the size of the 64-character hex strings.
+        self.hashes = {}
+        self.interned = {} # value of an intern_fields field -> the one string object every block uses for it
+        # epoch_ns of every block, by position (see blocks_between); 8 bytes per block.
+        # Sorted unless blocks loaded from a ledger go back in time, in which case range queries scan it instead
+        self.times = array("q")
+        self.times_sorted = True
+        self.graph = SupplyGraph() # location -> destination movements (see SupplyGraph)
+
+    def _add_block(self, block): # appends a block and keeps the indexes up to date
+        self.chain.append(block)
+        self._index_block(block)
+
+    def _index_block(self, block):
+        digest = _digest(block.hash)
+        if digest is not None:
+            self.hashes[digest] = block.index
+        self._add_time(block.timestamp)
+
+        data = block.data
+        interned = self.interned
+        for field in self.intern_fields: # swaps in the shared copy of each repeated value (an equal string, same hash)
+            value = data.get(field)
+            if type(value) is str:
+                data[field] = interned.setdefault(value, value)
+
+        batch_id = data.get("batch_id")
+        if _indexable(batch_id):
+            trail = self.trails.get(batch_id)
+            if trail is None:
+                # array("q") stores plain 8-byte integers, much smaller than a list of int objects
+                trail = self.trails[batch_id] = array("q")
+            trail.append(block.index)
+
+        self._add_postings(block.index, data, self.index_fields)
+        self.graph.add(data)
+
+    def _add_time(self, timestamp):
+        times = self.times
+        try:
+            when = epoch_ns(timestamp)
+        except (ValueError, TypeError): # not a time at all (e.g., hand-edited); file it with the block before it
+            when = times[-1] if times else 0
+        if times and when < times[-1]:
+            self.times_sorted = False
+        times.append(when)
+
+    def _add_postings(self, index, data, fields): # adds block index to the posting lists of its values for fields
+        postings = self.postings
+        for field in fields:
+            value = data.get(field)
+            if not _indexable(value):
+                continue # lists and dictionaries aren't indexed
+            posting = postings[field].get(value)
+            if posting is None:
+                posting = postings[field][value] = array("q")
+            posting.append(index)
+
+    def trail(self, batch_id):
+        """
+        Returns the full journey of a batch: every block with that batch_id, in chain order
+        (e.g., Manufactured -> Quality Tested -> Shipped -> ... -> Sold).
+        Uses the trails index, so it costs the length of the trail, not the length of the chain.
+        """
+        return [self.chain[i] for i in self.trails.get(batch_id, ())]
+
+    def posting(self, field, value): # sorted indexes of the blocks whose data[field] == value
+        if field not in self.postings:
+            raise ValueError(f"{field!r} is not indexed, expected one of {sorted(self.postings)}")
+        return self.postings[field].get(value, array("q"))
+
+    def matching(self, match="all", **fields):
+        """
+        Indexes of the blocks whose data matches fields, using the inverted indexes instead of scanning the chain.
+        * matching(event="Quality Tested", location="Warehouse X") -> blocks matching every condition (AND)
+        * match="any" returns the blocks matching at least one condition instead (OR)
+        * A list, tuple or set of values matches any of them: matching(location=["Warehouse X", "Warehouse Y"])
+        * Returns a sorted array("q") of indexes; find() returns the blocks themselves
+        """
+        if match not in ("all", "any"):
+            raise ValueError(f"match must be 'all' or 'any', not {match!r}")
+        postings = []
+        for field, value in fields.items():
+            if isinstance(value, (list, tuple, set, frozenset)):
+                postings.append(union_postings(*(self.posting(field, v) for v in value)) if value else array("q"))
+            else:
+                postings.append(self.posting(field, value))
+        if not postings:
+            return array("q", range(len(self.chain)))
+        return intersect_postings(*postings) if match == "all" else union_postings(*postings)
+
+    def find(self, match="all", **fields): # the blocks matching(match, **fields), in chain order
+        return [self.chain[i] for i in self.matching(match, **fields)]
+
+    def time_range(self, t0, t1):
+        """
+        Positions of the blocks created at or after t0 and before t1 (epoch nanoseconds, e.g., from time.time_ns()
+        or epoch_ns), as a range. Two binary searches over the times array, so the cost doesn't depend on chain length.
+        (If loaded blocks go back in time the array isn't sorted, and the matching positions are listed by a scan.)
+        """
+        times = self.times
+        if self.times_sorted:
+            return range(bisect_left(times, t0), bisect_left(times, t1))
+        return [position for position, when in enumerate(times) if t0 <= when < t1]
+
+    def query(self): # a Query over all of this chain's blocks, to narrow down with where, between and limit
+        return Query(self)
+
+    def blocks_between(self, t0, t1): # the blocks created in [t0, t1) (epoch nanoseconds), in chain order
+        return [self.chain[position] for position in self.time_range(t0, t1)]
+
+    def recall_impact(self, subject, window=None, max_hops=4):
+        """
+        Blast radius of a recall: a bounded breadth-first search over the batches and locations linked through the chain,
+        streaming an Impact for everything affected as soon as it's found (nearest first).
+        * Each Impact says since when (since, epoch nanoseconds) something is affected, and through which contact (via, at
+          block index). If a later step finds an earlier contact with something already reported, it's reported again
+          with the earlier time: the last Impact for a (kind, name) is the one that holds
+        * subject is a batch_id, or else a location (facility) name
+        * From a batch, every location it was at or was shipped to is affected; from a location, every batch
+          that was there or was shipped there. Contact only spreads forward in time: a batch reached at
+          time t affects only the places it goes from t on, and a location only the batches there from t on
+        * window=(t0, t1) in epoch nanoseconds limits the search to the blocks created in [t0, t1)
+        * max_hops bounds the search (batch -> location counts as one hop, location -> batch as another)
+        * Uses the trails, the location / destination posting lists and the times array, so each step costs the number
+          of blocks it touches, never a pass over the chain; "location" must be one of index_fields
+        """
+        t0, t1 = window if window is not None else (-2 ** 63, 2 ** 63 - 1)
+        if subject in self.trails:
+            start = ("batch", subject)
+        elif self.posting("location", subject) or subject in self.graph.predecessors:
+            start = ("location", subject)
+        else:
+            raise ValueError(f"{subject!r} is neither a batch_id nor a location on the chain")
+        return self._recall(start, t0, t1, max_hops)
+
+    def _recall(self, start, t0, t1, max_hops):
+        chain = self.chain
+        earliest = {start: t0} # (kind, name) -> earliest contact found so far
+        expanded = {} # (kind, name) -> earliest contact searched from so far
+        frontier = deque([(start, t0, 0)])
+        while frontier:
+            node, since, hops = frontier.popleft()
+            if (node in expanded and expanded[node] <= since) or hops >= max_hops:
+                # everything reachable from this contact was already searched from an earlier one with no more hops
+                # (contacts come off the queue in hop order), or the search is deep enough
+                continue
+            expanded[node] = since
+            kind, name = node
+            if kind == "batch":
+                contacts = []
+                for position in self._positions_within(self.trails[name], since, t1):
+                    data = chain[position].data
+                    for field in ("location", "destination"):
+                        if type(data.get(field)) is str:
+                            contacts.append((("location", data[field]), position))
+            else:
+                postings = [self._positions_within(self.posting("location", name), since, t1)]
+                if "destination" in self.postings:
+                    postings.append(self._positions_within(self.posting("destination", name), since, t1))
+                contacts = ((("batch", chain[position].data.get("batch_id")), position)
+                            for position in heapq.merge(*postings))
+
+            for found, position in contacts:
+                if not _indexable(found[1]):
+                    continue # an event without a batch_id (or with a list of them)
+                when = self.times[position]
+                best = earliest.get(found)
+                if best is not None and best <= when:
+                    continue
+                earliest[found] = when
+                yield Impact(found[0], found[1], hops + 1, when, name, position) # (again, if it was reported later before)
+                frontier.append((found, when, hops + 1))
+
+    def _positions_within(self, positions, t0, t1): # the entries of a sorted posting list created in [t0, t1)
+        times = self.times
+        if self.times_sorted:
+            low = bisect_left(positions, bisect_left(times, t0))
+            high = bisect_left(positions, bisect_left(times, t1))
+            return map(positions.__getitem__, range(low, high))
+        return (position for position in positions if t0 <= times[position] < t1)
+
+    def get_by_hash(self, block_hash): # finds a block by its hex hash in O(1), or returns None
+        index = self.hashes.get(_digest(block_hash))
+        return None if index is None else self.chain[index]
+
+    def get_parent(self, block): # the block this one links to through its previous hash (None for genesis)
+        return self.get_by_hash(block.prev_hash)
+
+    def _index_state(self): # every index derived from the blocks, for snapshots
+        return {"trails": self.trails, "hashes": self.hashes, "interned": self.interned, "postings": self.postings,
+                "times": self.times, "times_sorted": self.times_sorted, "graph": self.graph}
+
+    def _restore_index_state(self, state, length):
+        # state covers the first length blocks of the chain
+        self.trails = state["trails"]
+        self.hashes = state["hashes"]
+        self.interned = state.get("interned", {})
+        if "times" in state:
+            self.times = state["times"]
+            self.times_sorted = state["times_sorted"]
+        else:
+            self.times = array("q")
+            self.times_sorted = True
+            for block in itertools.islice(self.chain, length):
+                self._add_time(block.timestamp)
+        if "graph" in state:
+            self.graph = state["graph"]
+        else:
+            self.graph = SupplyGraph()
+            for block in itertools.islice(self.chain, length):
+                self.graph.add(block.data)
+        if "postings" in state and set(state["postings"]) == set(self.postings):
+            self.postings = state["postings"]
+            self.trails = self.postings["batch_id"]
+        else: # the snapshot was taken with other index_fields, so rebuild them
+            self.postings = {field: {} for field in self.index_fields}
+            self.postings["batch_id"] = self.trails
+            for block in itertools.islice(self.chain, length):
+                self._add_postings(block.index, block.data, self.index_fields)
+
+    def _maybe_snapshot(self): # saves a periodic snapshot if enough blocks were added since the last one
+        if self.snapshot_path is not None and len(self.chain) - self._snapshot_length >= self.snapshot_every:
+            self.save_snapshot(self.snapshot_path)
+
+    def save_snapshot(self, snapshot_path):
+        """
+        Saves the chain's state so a restart doesn't have to rebuild it from genesis (see restore):
+        the chain length and tip hash, every derived index (batch trails, hash index, ...), the verified-up-to and
+        persisted watermarks, and how far each ledger had been written.
+        * With the default MemoryStorage the blocks themselves are included; a persistent storage already has them
+        * The file is written to a temporary name and then renamed, so a crash never leaves half a snapshot,
+          and a SHA-256 checksum of the contents is checked when it's read back
+        """
+        last = self.chain[-1]
+        state = {
+            "version": 1,
+            "length": len(self.chain),
+            "tip": last.hash,
+            "hash_format": self.hash_format,
+            "legacy_json": self.legacy_json,
+            "blocks": ([(b.index, b.timestamp, b.data, b.prev_hash, b.hash, b.hash_format) for b in self.chain]
+                       if isinstance(self.chain, MemoryStorage) else None),
+            "indexes": self._index_state(),
+            "verified": self.verified,
+            "persisted": self.persisted,
+            "ledger_offsets": self.ledger_offsets,
+        }
+        payload = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+        temp_path = snapshot_path + ".tmp"
+        with open(temp_path, "wb") as snapshot:
+            snapshot.write(_SNAPSHOT_MAGIC + hashlib.sha256(payload).digest() + payload)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(temp_path, snapshot_path)
+        _fsync_directory(os.path.dirname(snapshot_path))
+        self._snapshot_length = len(self.chain)
+
+    @classmethod
+    def restore(cls, snapshot_path, ledger_path=None, verify=True, **options):
+        """
+        Fast startup: restores a snapshot saved by save_snapshot, then replays only the part of the ledger
+        written after it, so startup time depends on how much is new rather than on the ledger's whole history.
+        * ledger_path is the CSV ledger or SegmentLog directory to catch up from (None skips catching up)
+        * verify=True recomputes the hashes of the replayed blocks (the snapshot's blocks were already loaded once)
+        * options are passed on to PharmaBlockChain; pass the same storage the snapshot was taken from
+        * Snapshots are unpickled, so only restore files this service wrote itself
+        """
+        with open(snapshot_path, "rb") as snapshot:
+            raw = snapshot.read()
+        magic, checksum, payload = raw[:len(_SNAPSHOT_MAGIC)], raw[len(_SNAPSHOT_MAGIC):len(_SNAPSHOT_MAGIC) + 32], raw[len(_SNAPSHOT_MAGIC) + 32:]
+        if magic != _SNAPSHOT_MAGIC or hashlib.sha256(payload).digest() != checksum:
+            raise ValueError(f"{snapshot_path} is not a valid snapshot")
+        state = pickle.loads(payload)
+
+        options.setdefault("hash_format", state["hash_format"])
+        options.setdefault("legacy_json", state["legacy_json"])
+        storage = options.pop("storage", None)
+        # starts out in memory, so the blocks already in storage aren't indexed only for the snapshot to replace it
+        chain = cls._for_loading(options)
+        if storage is not None:
+            chain.chain = storage
+        length = state["length"]
+        if state["blocks"] is not None:
+            chain._clear()
+            append = chain.chain.append
+            for fields in state["blocks"]:
+                append(Block(*fields))
+        if len(chain.chain) < length or chain.chain[length - 1].hash != state["tip"]:
+            raise ValueError(f"{snapshot_path} does not match the chain in storage")
+        chain._restore_index_state(state["indexes"], length)
+        for block in chain.chain.iter_from(length): # storage may already hold blocks newer than the snapshot
+            chain._index_block(block)
+        chain.verified = state["verified"]
+        chain.persisted = state["persisted"]
+        chain.ledger_offsets = state["ledger_offsets"]
+        chain._snapshot_length = length
+
+        if ledger_path is not None:
+            tip = chain.chain[-1]
+            if os.path.isdir(ledger_path):
+                newer = SegmentLog(ledger_path).iter_from(len(chain.chain))
+            else:
+                watermark = chain.persisted.get(ledger_path)
+                if watermark is None or ledger_path not in chain.ledger_offsets:
+                    raise ValueError(f"The snapshot doesn't record where {ledger_path} left off")
+                newer = _csv_blocks(ledger_path, chain.hash_format, chain.ledger_offsets[ledger_path],
+                                    watermark[0] + 1, watermark[1])
+
+            def unknown(blocks): # skips blocks the snapshot already has (after checking they are the same)
+                for block in blocks:
+                    if block.index < len(chain.chain):
+                        if chain.chain[block.index].hash != block.hash:
+                            raise ValueError(f"{ledger_path}: block {block.index} differs from the snapshot")
+                        continue
+                    yield block
+
+            newer = unknown(newer)
+            first = next(newer, None)
+            if first is not None:
+                fully_verified = chain.verified.get("full") == (tip.index, tip.hash)
+                chain._extend_loaded(first, newer, ledger_path, verify)
+                last = chain.chain[-1]
+                chain.persisted[ledger_path] = (last.index, last.hash)
+                if fully_verified and verify:
+                    chain.verified["full"] = chain.verified["links"] = (last.index, last.hash)
+            if not os.path.isdir(ledger_path):
+                chain.ledger_offsets[ledger_path] = os.path.getsize(ledger_path)
+
+        if chain.wal is not None:
+            chain._replay_wal()
+        return chain
 
     def generate_genesis_block(self): # first block, serves as a starting point.
         # Uses "0" as previous hash since no previous block exists
-        return Block(0,time.ctime(), {"Event": "Genesis Block"}, "0")
+        return Block(0,time.time_ns(), {"Event": "Genesis Block"}, "0", hash_format=self.hash_format)
 
     def retrieve_block(self):
         # retrieves the latest block, which is needed to link the next new block to the correct previous hash
         return self.chain[-1]
 
     def create_block(self, data): # adds new block to the chain
-        last_block = self.retrieve_block()
-
-        # create a new block linked to the last one
-        new_block = Block(
-            index=last_block.index + 1,
-            timestamp=time.ctime(),
-            data=data,
-            prev_hash=last_block.hash
-        )
-        self.chain.append(new_block)
-
-    def validation(self): # determines if the block is valid
-        for i in range(1, len(self.chain)):
-            current_block = self.chain[i]
-            previous_block = self.chain[i - 1]
-
-            if current_block.prev_hash != previous_block.hash: # if the block's hash doesn't match the previous hash
-                print(f"Block {i} has been tampered with")
-                return False
+        _check_data(data)
+        with self._lock:
+            last_block = self.retrieve_block()
+
+            # create a new block linked to the last one
+            new_block = Block(
+                index=last_block.index + 1,
+                timestamp=max(time.time_ns(), self.times[-1]), # never earlier than the block before, if the clock steps back
+                data=data,
+                prev_hash=last_block.hash,
+                hash_format=self.hash_format
+            )
+            sequence = self._journal(new_block)
+            self._add_block(new_block)
+            self.chain.commit()
+        # wait for the disk outside the lock, so other threads' blocks can join the same group commit
+        if sequence is not None:
+            self.wal.wait(sequence)
+
+    def _journal(self, block): # writes a block to the write-ahead log (if there is one); returns its sequence number
+        return None if self.wal is None else self.wal.append(block)
+
+    def _replay_wal(self):
+        """
+        Adds the blocks from the write-ahead log that this chain doesn't have yet (e.g., ones created after
+        the ledger was last written, before a crash). Blocks the chain already has must match exactly.
+        """
+        for block in self.wal.replay():
+            if block.index < len(self.chain):
+                if self.chain[block.index].hash != block.hash:
+                    raise ValueError(f"{self.wal.path}: block {block.index} differs from the chain")
+                continue
+            if block.index > len(self.chain):
+                raise ValueError(f"{self.wal.path}: the journal starts at block {block.index} but the chain only has "
+                                 f"{len(self.chain)} blocks. It was checkpointed into a ledger; open it together with "
+                                 f"that ledger, with PharmaBlockChain.open(ledger, wal=...) or load(ledger, wal=...)")
+            if block.index != len(self.chain) or (len(self.chain) and block.prev_hash != self.chain[-1].hash):
+                raise ValueError(f"{self.wal.path}: block {block.index} does not continue the chain")
+            if not self.verify_block(block):
+                raise ValueError(f"{self.wal.path}: block {block.index} does not match its hash")
+            self._add_block(block)
+        self.chain.commit()
+
+    def checkpoint(self, ledger_path):
+        """
+        Writes the chain to the CSV ledger, syncs it to disk, and then empties the write-ahead log,
+        since every journaled block is now safely in the ledger. Keeps the journal from growing forever.
+        """
+        with self._lock:
+            self.write_chain(ledger_path, sync=True)
+            if self.wal is not None:
+                self.wal.truncate(self.persisted[ledger_path][0])
+
+    def create_blocks(self, events): # adds many new blocks to the chain in one go
+        """
+        Bulk version of create_block for large imports (e.g., nightly EDI/EPCIS files).
+        * events can be any iterable or generator of data dictionaries; it is consumed lazily
+        * Each block is linked and hashed in one tight loop: the serializer, hash function and
+          list append are looked up once up front instead of once per event
+        * Returns the range of indexes that were added (empty if events was empty)
+        """
+        with self._lock:
+            serialize = HASH_FORMATS[self.hash_format]
+            hash_format = self.hash_format
+            sha256 = hashlib.sha256
+            append = self.chain.append
+            index_block = self._index_block
+            journal = self._journal
+            now = time.time_ns
+
+            last_block = self.retrieve_block()
+            index = last_block.index
+            prev_hash = last_block.hash
+            first_index = index + 1
+            sequence = None
+            last_time = self.times[-1]
+
+            for data in events:
+                _check_data(data)
+                index += 1
+                timestamp = now()
+                if timestamp < last_time: # the clock stepped back; keep timestamps in chain order
+                    timestamp = last_time
+                last_time = timestamp
+                block_hash = sha256(serialize(index, timestamp, data, prev_hash)).hexdigest()
+                block = Block(index, timestamp, data, prev_hash, block_hash, hash_format)
+                sequence = journal(block)
+                append(block)
+                index_block(block)
+                prev_hash = block_hash
+
+            self.chain.commit()
+        if sequence is not None:
+            self.wal.wait(sequence) # one wait for the whole batch
+
+        return range(first_index, index + 1)
+
+    def verify_block(self, block): # checks that a block's stored hash matches its contents
+        return _recompute_hash(block.index, block.timestamp, block.data, block.prev_hash,
+                               block.hash, block.hash_format, self.legacy_json) is None
+
+    def validation(self, mode="links", workers=None, force=False): # determines if the block is valid
+        """
+        Quick yes/no check; use find_tampering for the full list of problems.
+        * Only the blocks added since the last successful validation in this mode are checked,
+          so the cost grows with the size of each new batch rather than the age of the ledger
+           - a "full" validation also counts as a "links" one
+           - if the block under the watermark no longer has the same hash, everything is checked again
+        * force=True ignores the watermark and re-checks the whole chain (e.g., for an audit)
+        """
+        start = 0 if force else self.verified_start(mode)
+        for problem in self.find_tampering(mode, workers, start):
+            print(f"Block {problem.index} has been tampered with")
+            return False
+
+        last = self.chain[-1]
+        self.verified[mode] = (len(self.chain) - 1, last.hash)
+        if mode == "full":
+            self.verified["links"] = self.verified["full"]
         return True
 
-    def write_chain(self, ledger_path): # writes to a CSV file
+    def verified_start(self, mode): # first chain position that has not been verified in this mode yet
+        watermark = self.verified.get(mode)
+        if watermark is None:
+            return 0
+        position, block_hash = watermark
+        if position >= len(self.chain) or self.chain[position].hash != block_hash:
+            return 0 # the chain changed under the watermark, so nothing can be trusted
+        return position + 1
+
+    def find_tampering(self, mode="links", workers=None, start=0):
+        """
+        Yields a Tampering for every bad block from chain position start onward, in chain order, in a single pass.
+        It is a generator, so a ledger with many corrupted ranges never has its findings built up in memory,
+        and callers can stop early (like validation does) or collect everything for a forensic report.
+        * mode="links" only checks that each block's previous hash matches the hash of the block before it
+        * mode="full" also recomputes every block's hash, so a block whose data was edited in place is caught too.
+          The chain is split into contiguous ranges that are re-hashed on a pool of worker processes
+          (workers defaults to one per CPU core), then the links between neighbouring ranges are checked here
+        """
+        if mode == "links":
+            start = max(start, 1)
+            if start >= len(self.chain):
+                return
+            # walks the chain once, remembering the previous block, so a storage backend streams it in order
+            blocks = self.chain.iter_from(start - 1)
+            previous_block = next(blocks)
+            for i, current_block in enumerate(blocks, start):
+                if current_block.prev_hash != previous_block.hash: # if the block's hash doesn't match the previous hash
+                    yield Tampering(i, "link", previous_block.hash, current_block.prev_hash)
+                previous_block = current_block
+        elif mode == "full":
+            yield from self._full_check(workers, start=start)
+        else:
+            raise ValueError(f"Unknown validation mode {mode!r}, expected 'links' or 'full'")
+
+    def _full_check(self, workers=None, range_size=None, start=0):
+        # yields a Tampering for every bad block from position start onward, in chain order
+        length = len(self.chain)
+        workers = workers or os.cpu_count() or 1
+        range_size = range_size or max(1000, -(-(length - start) // (workers * 4))) # a few ranges per worker evens out the load
+        starts = range(start, length, range_size)
+
+        def rows(start): # the plain fields of one range, which are cheap to send to another process
+            return [(b.index, b.timestamp, b.data, b.prev_hash, b.hash, b.hash_format)
+                    for b in self.chain[start:start + range_size]]
+
+        if workers == 1 or len(starts) <= 1: # not worth starting processes for
+            results = (_verify_range(start, rows(start), self.legacy_json) for start in starts)
+            yield from self._stitch(starts, results)
+            return
+
+        def results(pool): # keeps only a couple of ranges per worker in flight, so memory stays bounded
+            pending = deque()
+            for start in starts:
+                pending.append(pool.submit(_verify_range, start, rows(start), self.legacy_json))
+                if len(pending) >= workers * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            yield from self._stitch(starts, results(pool))
+
+    def _stitch(self, starts, results):
+        # merges the per-range results, checking the link into the first block of every range but the first
+        for start, bad in zip(starts, results):
+            if start > 0 and self.chain[start].prev_hash != self.chain[start - 1].hash:
+                yield Tampering(start, "link", self.chain[start - 1].hash, self.chain[start].prev_hash)
+            yield from bad
+
+    def write_chain(self, ledger_path, sync=False): # writes to a CSV file
         """
         Writes the blockchain's contents to a CSV file.
         If the file doesn't exist, a new one is created
-        If the file is empty, or is missing a header, a header is written first.
+        If the file is empty, a header is written first.
+
+        * Only blocks that are not on disk yet get written. The chain remembers a watermark
+          (index + hash of the last block written to each ledger), so calling this after every
+          new block appends just the new tail instead of duplicating every earlier row.
+           - The header check only happens the first time a ledger is opened by this chain
+           - A ledger that already holds rows this chain hasn't written (or loaded) is refused with a ValueError,
+             since appending this chain's genesis block after them would break the ledger.
+             Continue an existing ledger with PharmaBlockChain.open or load instead
+           - If the block under the watermark no longer has the same hash, the chain was rewritten
+             after it was persisted, and appending to the ledger would break it, so a ValueError is raised
+        * sync=True makes sure the rows are on disk (fsync) before returning
+        * Threads that create blocks meanwhile wait for the write to finish; their blocks go out with the next call
         """
-        header_needed = False
+        with self._lock: # a block added halfway through would be marked persisted without being written
+            start = self._unpersisted_start(ledger_path)
 
-        # Check if file is missing or empty
-        if not os.path.exists(ledger_path) or os.stat(ledger_path).st_size == 0:
-            header_needed = True
-        else:
-            # If file exists, check the first line for correct header
-            with open(ledger_path, "r") as csv_ledger:
-                first_line = csv_ledger.readline()
-                if "Timestamp" not in first_line:
+            if start is None:
+                start = 0
+                header_needed = False
+
+                # Check if file is missing or empty
+                if not os.path.exists(ledger_path) or os.stat(ledger_path).st_size == 0:
                     header_needed = True
+                else:
+                    # If file exists, it may only hold the header
+                    with open(ledger_path, "r") as csv_ledger:
+                        first_line = csv_ledger.readline()
+                        holds_rows = "Timestamp" not in first_line or csv_ledger.readline().strip() != ""
+                    if holds_rows:
+                        raise ValueError(f"{ledger_path} already holds a ledger this chain didn't write")
+            else:
+                header_needed = False
+                expected_size = self.ledger_offsets.get(ledger_path)
+                if expected_size is not None and os.path.getsize(ledger_path) != expected_size:
+                    # rows were added (or removed) by someone else, so the watermark no longer describes the file
+                    raise ValueError(f"{ledger_path} changed since this chain last wrote it")
+
+            if start >= len(self.chain) and not header_needed and not sync:
+                return # nothing new to write
 
-        # Open the file in append mode
-        with open(ledger_path, "a", newline="") as csv_ledger:
-            appender = csv.writer(csv_ledger)
+            # Open the file in append mode
+            with open(ledger_path, "a", newline="") as csv_ledger:
+                appender = csv.writer(csv_ledger)
 
-            # Write the header if necessary
-            if header_needed:
-                appender.writerow(["Timestamp", "Data", "Hash"])
+                # Write the header if necessary
+                if header_needed:
+                    appender.writerow(["Timestamp", "Data", "Hash"])
+
+                # Write each new block's data into the CSV
+                for block in self.chain.iter_from(start):
+                    # Serialize the data dictionary into a readable string (like JSON) for CSV storage
+                    data_string = json.dumps(block.data, sort_keys=True)
+                    appender.writerow([block.timestamp, data_string, block.hash])
+
+                if sync:
+                    csv_ledger.flush()
+                    os.fsync(csv_ledger.fileno())
+
+            last = self.chain[-1]
+            self.persisted[ledger_path] = (last.index, last.hash)
+            self.ledger_offsets[ledger_path] = os.path.getsize(ledger_path)
+            self._maybe_snapshot()
+
+    def iter_jsonl(self, start=0):
+        """
+        Yields the chain as JSON Lines, one line per block from position start onward, for ETL and analytics jobs.
+        Each line is an object with every field of the block: index, timestamp, data, prev_hash, hash and hash_format.
+        Lines are produced one at a time, so streaming a chain of any length uses constant memory.
+        """
+        dumps = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False).encode
+        for block in self.chain.iter_from(start):
+            yield dumps({
+                "index": block.index,
+                "timestamp": block.timestamp,
+                "data": block.data,
+                "prev_hash": block.prev_hash,
+                "hash": block.hash,
+                "hash_format": block.hash_format,
+            }) + "\n"
+
+    def write_jsonl(self, path, sync=False):
+        """
+        Writes the chain to a JSON Lines ledger (see iter_jsonl), which keeps every field of every block,
+        unlike the CSV ledger. Load it back with load_jsonl.
+        * Like write_chain, only blocks that are not in the file yet are appended
+        * A file this chain hasn't written (or loaded) must be empty or missing, so it's never appended to twice
+        * sync=True makes sure the lines are on disk (fsync) before returning
+        """
+        with self._lock:
+            start = self._unpersisted_start(path)
+            if start is None:
+                if os.path.exists(path) and os.path.getsize(path):
+                    raise ValueError(f"{path} already holds a ledger this chain didn't write")
+                start = 0
+            elif os.path.getsize(path) != self.ledger_offsets.get(path):
+                raise ValueError(f"{path} changed since this chain last wrote it")
+
+            with open(path, "a", encoding="utf-8", newline="\n") as jsonl_ledger:
+                jsonl_ledger.writelines(self.iter_jsonl(start))
+                if sync:
+                    jsonl_ledger.flush()
+                    os.fsync(jsonl_ledger.fileno())
+
+            last = self.chain[-1]
+            self.persisted[path] = (last.index, last.hash)
+            self.ledger_offsets[path] = os.path.getsize(path)
+            self._maybe_snapshot()
+
+    def _unpersisted_start(self, target):
+        # first chain position not yet written to target, or None if this chain has never written there
+        watermark = self.persisted.get(target)
+        if watermark is None:
+            return None
+        last_index, last_hash = watermark
+        if last_index >= len(self.chain) or self.chain[last_index].hash != last_hash:
+            raise ValueError(f"Block {last_index} changed after it was written to {target}")
+        return last_index + 1
+
+    def write_segments(self, directory, segment_bytes=64 * 1024 * 1024):
+        """
+        Appends the chain to a binary SegmentLog in directory.
+        Like write_chain, only blocks that aren't in the log yet are written. If this chain has never written
+        to the directory but it already holds a log, the log's newest block must be one of this chain's blocks,
+        otherwise appending would fork the ledger and a ValueError is raised.
+        The log stays open in segment_logs between calls, so appending a few blocks doesn't reopen the segment
+        or reread the field dictionary every time.
+        """
+        with self._lock:
+            log = self.segment_logs.get(directory)
+            if log is None:
+                log = SegmentLog(directory, segment_bytes, self.intern_fields)
+            log.segment_bytes = segment_bytes
 
-            # Write each block's data into the CSV
-            for block in self.chain:
-                # Serialize the data dictionary into a readable string (like JSON) for CSV storage
-                data_string = json.dumps(block.data, sort_keys=True)
-                appender.writerow([block.timestamp, data_string, block.hash])
+            start = self._unpersisted_start(directory)
+            if start is None:
+                newest = log.last_block()
+                if newest is None:
+                    start = 0
+                elif newest.index < len(self.chain) and self.chain[newest.index].hash == newest.hash:
+                    start = newest.index + 1
+                else:
+                    log.close()
+                    raise ValueError(f"The ledger in {directory} belongs to a different chain")
+            self.segment_logs[directory] = log
+
+            for block in self.chain.iter_from(start):
+                log.append(block)
+            log.flush()
+
+            last = self.chain[-1]
+            self.persisted[directory] = (last.index, last.hash)
+            self._maybe_snapshot()
+
+    def write_archive(self, path, codec="zlib", frame_blocks=1024):
+        """
+        Writes the whole chain to a compressed archive (see CompressedLedger) for storing or replicating off-site,
+        and returns it opened. Frames of frame_blocks blocks are compressed with codec ("zlib" or "lzma");
+        bigger frames compress better, smaller ones make reading a single block cheaper.
+        Unlike write_chain, an archive is always rewritten in full: it is a snapshot of the ledger, not a journal.
+        """
+        return CompressedLedger.write(path, self.chain, codec, frame_blocks)
 
     def display_chain(self): # displays all the data within each block, including their hash values
         for block in self.chain:
             print(f"\nBlock #{block.index}")
-            print(f"Timestamp: {block.timestamp}")
+            print(f"Timestamp: {block.ctime}")
             print(f"Event: {block.data.get('event', 'N/A')}")
             print(f"Batch ID: {block.data.get('batch_id', 'N/A')}")
             print(f"Location: {block.data.get('location', 'N/A')}")
@@ -119,84 +2566,85 @@ class PharmaBlockChain:
     def last_block(self):
         return self.chain[-1] # returns most recent block in the chain
 
-ledger = "my_ledger.csv"
+if __name__ == "__main__": # only runs the demo when main.py is run directly, not when imported
+    ledger = "my_ledger.csv"
 
-myblockchain = PharmaBlockChain() # Creates the first block
+    myblockchain = PharmaBlockChain.open(ledger) # Continues the ledger from earlier runs, or creates the first block
 
-# Simulating a real pharmaceutical product journey through the supply chain
-#1 Manufactured
-myblockchain.create_block({
-        "event": "Manufactured",
+    # Simulating a real pharmaceutical product journey through the supply chain
+    #1 Manufactured
+    myblockchain.create_block({
+            "event": "Manufactured",
+            "batch_id": "Batch 1",
+            "location": "Factory A",
+            "destination": "Distributor 1"})
+
+    #2 Quality test
+    myblockchain.create_block({
+        "event": "Quality Tested",
         "batch_id": "Batch 1",
-        "location": "Factory A",
+        "location": "Testing Lab A",
         "destination": "Distributor 1"})
 
-#2 Quality test
-myblockchain.create_block({
-    "event": "Quality Tested",
-    "batch_id": "Batch 1",
-    "location": "Testing Lab A",
-    "destination": "Distributor 1"})
-
-#3 Shipped to Distributor
-myblockchain.create_block({
-    "event": "Shipped",
-    "batch_id": "Batch 1",
-    "location": "Factory A",
-    "destination": "Distributor 1"
-})
-
-#4 Received by Distributor
-myblockchain.create_block({
-    "event": "Received",
-    "batch_id": "Batch 1",
-    "location": "Distributor 1",
-    "destination": "Warehouse X"
-})
-
-#5 Shipped to Pharmacy
-myblockchain.create_block({
-    "event": "Shipped",
-    "batch_id": "Batch 1",
-    "location": "Warehouse X",
-    "destination": "CVS Pharmacy"
-})
-
-#6 Received by Pharmacy
-myblockchain.create_block({
-    "event": "Received",
-    "batch_id": "Batch 1",
-    "location": "CVS Pharmacy",
-    "destination": "CVS Pharmacy"
-})
-
-#7 Sold to Customer
-myblockchain.create_block({
-    "event": "Sold",
-    "batch_id": "Batch 1",
-    "location": "Pharmacy X",
-    "destination": "End User"
-})
-
-
-myblockchain.write_chain(ledger)
-myblockchain.display_chain()
-
-#Tampered Block (Invalid): creates a block with a wrong previous hash to simulate tampering
-# This simulates data tampering, which should be detected during validation
-# This will not be written to the CSV file
-tampered_block = Block(
-    index=myblockchain.last_block.index + 1,
-    timestamp=time.ctime(),
-    data={
-        "event": "Mugged after purchase",
+    #3 Shipped to Distributor
+    myblockchain.create_block({
+        "event": "Shipped",
+        "batch_id": "Batch 1",
+        "location": "Factory A",
+        "destination": "Distributor 1"
+    })
+
+    #4 Received by Distributor
+    myblockchain.create_block({
+        "event": "Received",
         "batch_id": "Batch 1",
-        "location": "Dark alleyway",
-        "destination": "Albuquerque, New Mexico"
-    },
-    prev_hash="WhatAreTheOdds"  # Wrong previous hash
-)
-
-myblockchain.chain.append(tampered_block)
-is_valid = myblockchain.validation()
-print(f"\nBlockchain Validity: {is_valid}")
\ No newline at end of file
+        "location": "Distributor 1",
+        "destination": "Warehouse X"
+    })
+
+    #5 Shipped to Pharmacy
+    myblockchain.create_block({
+        "event": "Shipped",
+        "batch_id": "Batch 1",
+        "location": "Warehouse X",
+        "destination": "CVS Pharmacy"
+    })
+
+    #6 Received by Pharmacy
+    myblockchain.create_block({
+        "event": "Received",
+        "batch_id": "Batch 1",
+        "location": "CVS Pharmacy",
+        "destination": "CVS Pharmacy"
+    })
+
+    #7 Sold to Customer
+    myblockchain.create_block({
+        "event": "Sold",
+        "batch_id": "Batch 1",
+        "location": "Pharmacy X",
+        "destination": "End User"
+    })
+
+
+    myblockchain.write_chain(ledger)
+    myblockchain.display_chain()
+
+    #Tampered Block (Invalid): creates a block with a wrong previous hash to simulate tampering
+    # This simulates data tampering, which should be detected during validation
+    # This will not be written to the CSV file
+    tampered_block = Block(
+        index=myblockchain.last_block.index + 1,
+        timestamp=time.time_ns(),
+        data={
+            "event": "Mugged after purchase",
+            "batch_id": "Batch 1",
+            "location": "Dark alleyway",
+            "destination": "Albuquerque, New Mexico"
+        },
+        prev_hash="WhatAreTheOdds"  # Wrong previous hash
+    )
+
+    myblockchain.chain.append(tampered_block)
+    is_valid = myblockchain.validation()
+    print(f"\nBlockchain Validity: {is_valid}")
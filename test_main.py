@@ -0,0 +1,527 @@
+"""
+Tests for the on-disk formats of main.py, where silent corruption costs the most.
+Run with:
+
+    python -m pytest -q
+"""
+
+import os
+import threading
+from array import array
+
+import pytest
+
+from main import (FieldDictionary, LedgerReader, PharmaBlockChain, SegmentLog, SQLiteStorage, WriteAheadLog,
+                  decode_payload, encode_record, intersect_postings, recover_ledger, union_postings)
+
+
+def sample_event(i): # a supply-chain event like the ones in main.py's demo
+    return {
+        "event": ("Manufactured", "Quality Tested", "Shipped", "Received", "Sold")[i % 5],
+        "batch_id": f"Batch {i // 5}",
+        "location": f"Factory {i % 3}",
+        "destination": f"Distributor {i % 4}",
+        "quantity": i,
+    }
+
+
+def make_chain(blocks, **options): # a chain of blocks sample events, after its genesis block
+    chain = PharmaBlockChain(**options)
+    chain.create_blocks(sample_event(i) for i in range(blocks))
+    return chain
+
+
+def same_blocks(left, right): # whether two sequences of blocks hold the same fields
+    fields = lambda block: (block.index, block.timestamp, block.data, block.prev_hash, block.hash, block.hash_format)
+    return [fields(block) for block in left] == [fields(block) for block in right]
+
+
+# Binary ledger records and segments
+
+@pytest.mark.parametrize("hash_format", ["json", "canon-v1"])
+def test_record_round_trip(hash_format):
+    chain = make_chain(10, hash_format=hash_format)
+    for block in chain.chain:
+        record = encode_record(block)
+        assert same_blocks([decode_payload(record[8:])], [block])
+
+
+def test_dictionary_encoded_record_round_trip(tmp_path):
+    dictionary = FieldDictionary(str(tmp_path / "fields.dict"))
+    block = make_chain(1).chain[1]
+    record = encode_record(block, dictionary)
+    assert len(record) < len(encode_record(block))
+    decoded = decode_payload(record[8:], dictionary)
+    assert decoded.data == block.data
+    assert decoded.hash == block.hash
+    dictionary.close()
+
+
+def test_segment_log_round_trip_across_segments(tmp_path):
+    chain = make_chain(500)
+    directory = str(tmp_path / "ledger")
+    chain.write_segments(directory, segment_bytes=8 * 1024)
+    chain.segment_logs[directory].close()
+
+    log = SegmentLog(directory)
+    assert len(log.segments()) > 1
+    assert same_blocks(log, chain.chain)
+    assert same_blocks(log.iter_from(321), chain.chain[321:])
+    assert log.read(250).hash == chain.chain[250].hash
+    assert log.last_block().hash == chain.chain[-1].hash
+    log.close()
+
+    loaded = PharmaBlockChain.load_segments(directory)
+    assert same_blocks(loaded.chain, chain.chain)
+
+
+def test_write_segments_appends_only_new_blocks(tmp_path):
+    chain = make_chain(50)
+    directory = str(tmp_path / "ledger")
+    chain.write_segments(directory)
+    chain.create_blocks(sample_event(i) for i in range(50, 60))
+    chain.write_segments(directory)
+    chain.write_segments(directory) # nothing new
+    chain.segment_logs[directory].close()
+    assert same_blocks(PharmaBlockChain.load_segments(directory).chain, chain.chain)
+
+
+def test_ledger_reader_random_access(tmp_path):
+    chain = make_chain(300)
+    directory = str(tmp_path / "ledger")
+    chain.write_segments(directory, segment_bytes=4 * 1024)
+    chain.segment_logs[directory].close()
+    with LedgerReader(directory) as reader:
+        assert len(reader) == len(chain.chain)
+        assert same_blocks([reader[0], reader[150], reader[-1]], [chain.chain[0], chain.chain[150], chain.chain[-1]])
+        assert same_blocks(reader[100:110], chain.chain[100:110])
+
+
+def test_corrupted_record_fails_its_checksum(tmp_path):
+    chain = make_chain(20)
+    directory = str(tmp_path / "ledger")
+    chain.write_segments(directory)
+    chain.segment_logs[directory].close()
+    path = SegmentLog(directory).segments()[0][1]
+    with open(path, "r+b") as segment: # flip one byte in the middle of the file
+        segment.seek(os.path.getsize(path) // 2)
+        byte = segment.read(1)
+        segment.seek(-1, os.SEEK_CUR)
+        segment.write(bytes([byte[0] ^ 0xFF]))
+    with pytest.raises(ValueError):
+        list(SegmentLog(directory))
+
+
+# Torn-tail recovery after a crash in the middle of a write
+
+def csv_row_ends(path): # byte offset just after every line of a CSV ledger
+    with open(path, "rb") as ledger:
+        raw = ledger.read()
+    return [i + 1 for i, byte in enumerate(raw) if byte == ord("\n")]
+
+
+@pytest.mark.parametrize("cut", [1, 7, 40, "row"])
+def test_recover_ledger_drops_a_torn_csv_row(tmp_path, cut):
+    chain = make_chain(30)
+    path = str(tmp_path / "ledger.csv")
+    chain.write_chain(path)
+    ends = csv_row_ends(path)
+    size = os.path.getsize(path)
+    # cut=n leaves the last row n bytes short, "row" leaves just its first byte
+    cut_at = ends[-2] + 1 if cut == "row" else size - cut
+    with open(path, "rb") as ledger:
+        torn_bytes = ledger.read()[ends[-2]:cut_at]
+    os.truncate(path, cut_at)
+
+    assert recover_ledger(path) == len(torn_bytes)
+    assert os.path.getsize(path) == ends[-2]
+    with open(path + ".torn", "rb") as torn:
+        assert torn.read() == torn_bytes
+    assert same_blocks(PharmaBlockChain.load(path).chain, chain.chain[:-1])
+
+
+def test_open_recovers_a_torn_csv_and_continues_it(tmp_path):
+    chain = make_chain(20)
+    path = str(tmp_path / "ledger.csv")
+    chain.write_chain(path)
+    os.truncate(path, os.path.getsize(path) - 5)
+
+    reopened = PharmaBlockChain.open(path)
+    assert same_blocks(reopened.chain, chain.chain[:-1])
+    reopened.create_block(sample_event(99))
+    reopened.write_chain(path)
+    assert same_blocks(PharmaBlockChain.load(path).chain, reopened.chain)
+
+
+def test_recover_ledger_leaves_an_intact_csv_alone(tmp_path):
+    chain = make_chain(10)
+    path = str(tmp_path / "ledger.csv")
+    chain.write_chain(path)
+    size = os.path.getsize(path)
+    assert recover_ledger(path) == 0
+    assert os.path.getsize(path) == size
+    assert not os.path.exists(path + ".torn")
+
+
+def segment_record_ends(path): # byte offset just after every record of a segment
+    ends = []
+    for offset, payload in SegmentLog._records(path):
+        ends.append(offset + 8 + len(payload))
+    return ends
+
+
+@pytest.mark.parametrize("cut", [1, 5, 8, 30, "record"])
+def test_segment_recover_drops_a_torn_record(tmp_path, cut):
+    chain = make_chain(40)
+    directory = str(tmp_path / "ledger")
+    chain.write_segments(directory)
+    chain.segment_logs[directory].close()
+    path = SegmentLog(directory).segments()[-1][1]
+    ends = segment_record_ends(path)
+    # cut=n leaves the last record n bytes short, "record" leaves just the first byte of its header
+    cut_at = ends[-2] + 1 if cut == "record" else ends[-1] - cut
+    os.truncate(path, cut_at)
+
+    log = SegmentLog(directory)
+    assert log.recover() == cut_at - ends[-2]
+    assert os.path.getsize(path) == ends[-2]
+    assert os.path.getsize(path + ".torn") == cut_at - ends[-2]
+    assert SegmentLog.index_is_current(path)
+    assert same_blocks(PharmaBlockChain.load_segments(directory).chain, chain.chain[:-1])
+
+    # the repaired log can be appended to again
+    reopened = PharmaBlockChain.open(directory)
+    reopened.create_block(sample_event(99))
+    reopened.write_segments(directory)
+    reopened.segment_logs[directory].close()
+    assert same_blocks(PharmaBlockChain.load_segments(directory).chain, reopened.chain)
+
+
+def test_segment_recover_keeps_records_missing_from_the_index(tmp_path):
+    chain = make_chain(25)
+    directory = str(tmp_path / "ledger")
+    chain.write_segments(directory)
+    chain.segment_logs[directory].close()
+    path = SegmentLog(directory).segments()[-1][1]
+    index_path = path[:-4] + ".idx"
+    os.truncate(index_path, os.path.getsize(index_path) - 3 * 8) # the last three offsets never made it to disk
+
+    assert SegmentLog(directory).recover() == 0
+    assert SegmentLog.index_is_current(path)
+    assert same_blocks(PharmaBlockChain.load_segments(directory).chain, chain.chain)
+
+
+# Write-ahead log: replay, truncation and group commit
+
+def test_wal_replays_blocks_that_never_reached_the_ledger(tmp_path):
+    journal = str(tmp_path / "chain.wal")
+    chain = make_chain(0, wal=WriteAheadLog(journal))
+    chain.create_block(sample_event(0))
+    chain.create_blocks(sample_event(i) for i in range(1, 20))
+    chain.wal.close() # the process stops here, nothing was written to a ledger
+
+    restarted = PharmaBlockChain(wal=WriteAheadLog(journal))
+    assert same_blocks(restarted.chain, chain.chain)
+    assert restarted.validation("full")
+    restarted.wal.close()
+
+
+def test_wal_drops_a_torn_record(tmp_path):
+    journal = str(tmp_path / "chain.wal")
+    chain = make_chain(0, wal=WriteAheadLog(journal))
+    chain.create_blocks(sample_event(i) for i in range(10))
+    chain.wal.close()
+    size = os.path.getsize(journal)
+    os.truncate(journal, size - 3)
+
+    wal = WriteAheadLog(journal)
+    assert same_blocks(wal.replay(), chain.chain[:-1])
+    assert os.path.getsize(journal) < size - 3 # the torn record is cut off before anything is appended
+    wal.close()
+
+
+def test_wal_replay_after_checkpoint(tmp_path):
+    journal = str(tmp_path / "chain.wal")
+    ledger = str(tmp_path / "ledger.csv")
+    chain = make_chain(0, wal=WriteAheadLog(journal))
+    chain.create_blocks(sample_event(i) for i in range(10))
+    chain.checkpoint(ledger)
+    assert chain.wal.replay() == [] # everything is in the ledger now
+    chain.create_blocks(sample_event(i) for i in range(10, 15))
+    chain.wal.close() # the process stops before the next checkpoint
+
+    wal = WriteAheadLog(journal)
+    assert [block.index for block in wal.replay()] == list(range(11, 16))
+    # without its ledger, the journal can't be turned back into a chain
+    with pytest.raises(ValueError, match="checkpointed"):
+        PharmaBlockChain(wal=wal)
+    wal.close()
+
+    restarted = PharmaBlockChain.open(ledger, wal=WriteAheadLog(journal))
+    assert same_blocks(restarted.chain, chain.chain)
+    restarted.checkpoint(ledger)
+    restarted.wal.close()
+    assert same_blocks(PharmaBlockChain.load(ledger).chain, chain.chain)
+
+
+@pytest.mark.parametrize("storage", ["memory", "sqlite"])
+def test_group_commit_from_many_threads(tmp_path, storage):
+    journal = str(tmp_path / "chain.wal")
+    options = {"storage": SQLiteStorage(str(tmp_path / "chain.db"))} if storage == "sqlite" else {}
+    chain = PharmaBlockChain(wal=WriteAheadLog(journal, max_delay=0.005), **options)
+
+    def add_blocks(thread):
+        for i in range(25):
+            chain.create_block(sample_event(thread * 100 + i))
+
+    try:
+        threads = [threading.Thread(target=add_blocks, args=(thread,)) for thread in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(chain.chain) == 201
+        assert chain.validation("full")
+        assert chain.wal.syncs < 200 # appends from different threads shared fsyncs
+    finally:
+        chain.wal.close()
+        if storage == "sqlite":
+            chain.chain.close()
+    reopened = WriteAheadLog(journal)
+    assert len(reopened.replay()) == 201
+    reopened.close()
+
+
+def test_failed_sync_raises_instead_of_hanging(tmp_path, monkeypatch):
+    wal = WriteAheadLog(str(tmp_path / "chain.wal"))
+    chain = PharmaBlockChain(wal=None)
+    chain.wal = wal
+
+    def failing_fsync(fd):
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(os, "fsync", failing_fsync)
+    with pytest.raises(OSError, match="could not be synced"):
+        chain.create_block(sample_event(0))
+    with pytest.raises(OSError):
+        chain.create_block(sample_event(1))
+    monkeypatch.undo()
+    wal.close()
+
+
+def test_list_batch_id_is_journaled_and_replayed(tmp_path):
+    journal = str(tmp_path / "chain.wal")
+    chain = PharmaBlockChain(wal=WriteAheadLog(journal))
+    chain.create_block({"event": "Shipped", "batch_id": ["Batch 1", "Batch 2"], "location": "A", "destination": "B"})
+    chain.create_block(sample_event(0))
+    with pytest.raises(TypeError):
+        chain.create_block(["not", "a", "dict"]) # rejected before it reaches the journal
+    chain.wal.close()
+    assert len(chain.chain) == 3
+    assert chain.graph.successors == {"A": {"B": 1}, "Factory 0": {"Distributor 0": 1}}
+
+    restarted = PharmaBlockChain(wal=WriteAheadLog(journal))
+    assert same_blocks(restarted.chain, chain.chain)
+    assert [block.index for block in restarted.trail("Batch 0")] == [2]
+    restarted.wal.close()
+
+
+def test_write_chain_while_other_threads_add_blocks(tmp_path):
+    chain = PharmaBlockChain()
+    path = str(tmp_path / "ledger.csv")
+    done = threading.Event()
+
+    def add_blocks():
+        i = 0
+        while not done.is_set():
+            chain.create_block(sample_event(i))
+            i += 1
+
+    adder = threading.Thread(target=add_blocks)
+    adder.start()
+    try:
+        for _ in range(300):
+            chain.write_chain(path)
+    finally:
+        done.set()
+        adder.join()
+    chain.write_chain(path)
+    assert same_blocks(PharmaBlockChain.load(path).chain, chain.chain)
+
+
+# Inverted indexes and queries
+
+def merged(postings, keep): # what merging sorted posting lists should give, worked out with sets
+    return array("q", sorted(keep(*map(set, postings))))
+
+
+@pytest.mark.parametrize("postings", [
+    [array("q", [1, 4, 9, 16, 25]), array("q", range(0, 1000, 1))], # one much longer list: bisect
+    [array("q", range(0, 300, 2)), array("q", range(0, 300, 3)), array("q", range(0, 300, 5))], # similar lengths: walk
+    [array("q", [3, 7]), array("q", [])],
+    [array("q", range(100, 200)), array("q", range(0, 50)), array("q", range(10_000))],
+])
+def test_intersect_and_union_postings(postings):
+    assert intersect_postings(*postings) == merged(postings, set.intersection)
+    assert union_postings(*postings) == merged(postings, set.union)
+
+
+def test_matching_and_find():
+    chain = make_chain(100)
+    shipped_from_factory_0 = [block for block in chain.chain
+                              if block.data.get("event") == "Shipped" and block.data.get("location") == "Factory 0"]
+    assert chain.find(event="Shipped", location="Factory 0") == shipped_from_factory_0
+    assert list(chain.matching(match="any", event="Sold", location="Factory 1")) == [
+        block.index for block in chain.chain
+        if block.data.get("event") == "Sold" or block.data.get("location") == "Factory 1"]
+    assert list(chain.matching(batch_id=["Batch 2", "Batch 3"])) == list(range(11, 21))
+
+
+def test_query_picks_the_most_selective_index():
+    chain = make_chain(200)
+    target = chain.chain[42]
+    assert chain.query().where(quantity=7).explain() == "full scan (201 candidates), then check quantity"
+    assert chain.query().where(hash=[target.hash, chain.chain[7].hash]).explain() == "index hash (2 candidates)"
+    assert chain.query().where(event="Sold", batch_id="Batch 3").explain() == "index batch_id (5 candidates), then check event"
+    assert chain.query().between(chain.times[10], chain.times[20]).where(event="Sold").explain() == \
+        "index time (10 candidates), then check event"
+
+    assert chain.query().where(hash=target.hash).first() is target
+    assert [block.index for block in chain.query().where(hash=[chain.chain[7].hash, target.hash])] == [7, 42]
+    assert chain.query().where(event="Sold", batch_id="Batch 3").count() == 1
+    assert chain.query().where(quantity=[7, 8, 9]).count() == 3
+
+
+def sample_queries(chain): # queries that between them exercise every index, the pushdown and the checks after it
+    t0, t1 = chain.times[30], chain.times[90]
+    return [
+        chain.query().where(event="Shipped"),
+        chain.query().where(location=["Factory 0", "Factory 2"], event="Sold"),
+        chain.query().where(quantity=7),
+        chain.query().where(hash=[chain.chain[5].hash, chain.chain[77].hash, "f" * 64]),
+        chain.query().where(batch_id="Batch 4", hash=chain.chain[21].hash),
+        chain.query().between(t0, t1).where(destination="Distributor 1").limit(5),
+        chain.query().where(lambda block: block.data.get("quantity", 1) % 7 == 0, destination="Distributor 1"),
+        chain.query().between(t0, t1).between(chain.times[50], chain.times[140]),
+        chain.query().where(event="Received").limit(0),
+    ]
+
+
+def test_query_runs_the_same_on_memory_and_sqlite(tmp_path):
+    path = str(tmp_path / "ledger.csv")
+    make_chain(150).write_chain(path)
+    in_memory = PharmaBlockChain.load(path)
+    storage = SQLiteStorage(str(tmp_path / "chain.db"))
+    try:
+        in_sqlite = PharmaBlockChain.load(path, storage=storage)
+        assert in_sqlite.query().where(event="Shipped").explain() == "sqlite select on event"
+        for memory_query, sqlite_query in zip(sample_queries(in_memory), sample_queries(in_sqlite)):
+            expected = [block for block in in_memory.chain if all(
+                condition(block) for condition in query_conditions(memory_query))][:memory_query._limit]
+            assert same_blocks(list(memory_query), expected)
+            assert same_blocks(list(sqlite_query), expected)
+    finally:
+        storage.close()
+
+
+def query_conditions(query): # a query's conditions as plain functions of a block, for checking it by brute force
+    conditions = list(query._predicates)
+    for field, value in query._fields.items():
+        values = set(value) if isinstance(value, (list, tuple, set, frozenset)) else {value}
+        if field == "hash":
+            conditions.append(lambda block, values=values: block.hash in values)
+        else:
+            conditions.append(lambda block, field=field, values=values: block.data.get(field) in values)
+    if query._window is not None:
+        t0, t1 = query._window
+        conditions.append(lambda block: t0 <= block.epoch_ns < t1)
+    return conditions
+
+
+# Snapshots
+
+def same_indexes(left, right): # whether two chains have built the same trails, posting lists and graph
+    return (left.postings == right.postings and left.times == right.times and left.hashes == right.hashes
+            and left.graph.successors == right.graph.successors and left.graph.batch_edges == right.graph.batch_edges)
+
+
+def test_restore_catches_up_from_a_csv_ledger(tmp_path):
+    path = str(tmp_path / "ledger.csv")
+    snapshot = str(tmp_path / "chain.snap")
+    chain = make_chain(60)
+    chain.write_chain(path)
+    chain.save_snapshot(snapshot)
+    chain.create_blocks(sample_event(i) for i in range(60, 85))
+    chain.write_chain(path) # rows the snapshot doesn't have
+
+    restored = PharmaBlockChain.restore(snapshot, path)
+    assert same_blocks(restored.chain, chain.chain)
+    assert same_indexes(restored, PharmaBlockChain.load(path))
+    restored.create_block(sample_event(99)) # and it knows where the ledger left off
+    restored.write_chain(path)
+    assert same_blocks(PharmaBlockChain.load(path).chain, restored.chain)
+
+
+def test_restore_catches_up_from_segments(tmp_path):
+    directory = str(tmp_path / "ledger")
+    snapshot = str(tmp_path / "chain.snap")
+    chain = make_chain(60)
+    chain.write_segments(directory, segment_bytes=4 * 1024)
+    chain.save_snapshot(snapshot)
+    chain.create_blocks(sample_event(i) for i in range(60, 85))
+    chain.write_segments(directory, segment_bytes=4 * 1024)
+    chain.segment_logs[directory].close()
+
+    restored = PharmaBlockChain.restore(snapshot, directory)
+    assert same_blocks(restored.chain, chain.chain)
+    assert same_indexes(restored, PharmaBlockChain.load_segments(directory))
+
+
+def test_restore_refuses_a_corrupted_snapshot(tmp_path):
+    snapshot = str(tmp_path / "chain.snap")
+    make_chain(10).save_snapshot(snapshot)
+    with open(snapshot, "r+b") as snap:
+        snap.seek(-1, os.SEEK_END)
+        snap.write(b"\x00")
+    with pytest.raises(ValueError, match="not a valid snapshot"):
+        PharmaBlockChain.restore(snapshot)
+
+
+# Recall blast radius
+
+def final_impacts(impacts): # (kind, name) -> the Impact that holds, the last one reported for it
+    return {(impact.kind, impact.name): impact for impact in impacts}
+
+
+def test_recall_reports_the_earliest_contact():
+    chain = PharmaBlockChain()
+    for batch_id, location in [("B0", "L1"), ("B0", "L2"), ("B1", "L2"), ("B1", "L1")]:
+        chain.create_block({"event": "Received", "batch_id": batch_id, "location": location})
+
+    # B1 is reached through L1 (block 4) first, but its first contact is at L2 (block 3)
+    impact = final_impacts(chain.recall_impact("B0"))[("batch", "B1")]
+    assert (impact.hops, impact.via, impact.index, impact.since) == (2, "L2", 3, chain.times[3])
+
+
+def test_recall_only_spreads_forward_in_time():
+    chain = PharmaBlockChain()
+    for batch_id, location in [("Before", "L1"), ("B0", "L1"), ("After", "L1"), ("Before", "L2"), ("Other", "L2")]:
+        chain.create_block({"event": "Received", "batch_id": batch_id, "location": location})
+
+    # "Before" left L1 before B0 got there, so neither it nor L2 (where it went next) is affected
+    impacts = final_impacts(chain.recall_impact("B0"))
+    assert set(impacts) == {("location", "L1"), ("batch", "After")}
+    assert impacts[("batch", "After")].index == 3
+
+    # recalling the whole site catches every batch that was there, and where they went from then on
+    impacts = final_impacts(chain.recall_impact("L1"))
+    assert set(impacts) == {("batch", "Before"), ("batch", "B0"), ("batch", "After"), ("location", "L2"),
+                            ("batch", "Other")}
+    assert impacts[("batch", "Other")].hops == 3
+    assert set(final_impacts(chain.recall_impact("L1", max_hops=1))) == {("batch", "Before"), ("batch", "B0"),
+                                                                          ("batch", "After")}
+    # and a window leaves out what happened after it
+    window = (chain.times[1], chain.times[4])
+    assert set(final_impacts(chain.recall_impact("L1", window))) == {("batch", "Before"), ("batch", "B0"),
+                                                                     ("batch", "After")}